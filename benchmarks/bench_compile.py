@@ -0,0 +1,73 @@
+"""Compare script executions for two-phase, replayed and forked
+compilation
+
+Each statement of the script does `work` iterations of Python code, like
+the lookups a large event script does between branches.
+
+Usage: python benchmarks/bench_compile.py [max_branches] [work]
+"""
+import os
+import sys
+import time
+
+from compileengine.engine import Engine
+
+
+def make_script(branches, work):
+    def statement(engine, value):
+        sum(range(work))
+        engine.unknown(value, 2)
+
+    def script(engine):
+        statement(engine, 0x10)
+        for idx in range(branches):
+            if engine.branch(engine.vars.flags > idx):
+                statement(engine, 0x20)
+            else:
+                statement(engine, 0x30)
+        statement(engine, 0x40)
+    return script
+
+
+def two_phase_executions(paths):
+    """Executions the old two-phase compile needed for `paths`
+
+    Enumerating the paths ran the script once per node of the decision
+    tree, stopping at each new decision, then every path was replayed.
+    """
+    prefixes = set(path[:idx] for path in paths
+                   for idx in range(len(path)+1))
+    return len(prefixes)+len(paths)
+
+
+def measure(script, fork_paths):
+    engine = Engine()
+    engine.fork_paths = fork_paths
+    start = time.time()
+    root = engine.compile(script)
+    elapsed = (time.time()-start)*1000
+    return engine, bytes(engine.link(root)), elapsed
+
+
+def main(max_branches=10, work=20000):
+    print('{0:>8} {1:>8} {2:>10} {3:>8} {4:>8} {5:>8} {6:>12} {7:>12}'.format(
+        'branches', 'paths', 'two-phase', 'replays', 'forks', 'blocks',
+        'replay (ms)', 'fork (ms)'))
+    for branches in range(0, max_branches+1, 2):
+        script = make_script(branches, work)
+        engine, image, elapsed = measure(script, False)
+        if hasattr(os, 'fork'):
+            forked, forked_image, fork_elapsed = measure(script, True)
+            assert forked_image == image
+            forks = forked.forks
+        else:
+            forks, fork_elapsed = '-', float('nan')
+        print('{0:>8} {1:>8} {2:>10} {3:>8} {4:>8} {5:>8} {6:>12.2f} '
+              '{7:>12.2f}'.format(
+                  branches, len(engine.paths),
+                  two_phase_executions(engine.paths), engine.executions,
+                  forks, len(engine.blocks), elapsed, fork_elapsed))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,124 @@
+"""Compare the per-object memory of expressions and variables with the
+baseline classes, compare expression objects with an ExpressionTable, and
+check that variable references do not grow with the number of paths
+compiled
+
+The baseline classes are loaded from git, so this must run inside the
+repository checkout.
+
+Usage: python benchmarks/bench_memory.py [count] [max_branches]
+"""
+import os
+import subprocess
+import sys
+import tracemalloc
+import types
+
+from compileengine.engine import Engine
+from compileengine.expression import (
+    AssignmentExpression, Expression, ExpressionBlock, UnknownExpression)
+from compileengine.ir import ExpressionTable
+from compileengine.variable import Variable
+
+# The commit before expressions and variables used __slots__
+BASELINE = 'da85e4e'
+
+
+def load_baseline(path):
+    """Import `path` as it was in the BASELINE commit
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    source = subprocess.check_output(
+        ['git', 'show', '{0}:{1}'.format(BASELINE, path)], cwd=root)
+    name = 'baseline_{0}'.format(os.path.splitext(os.path.basename(path))[0])
+    module = types.ModuleType(name)
+    exec(compile(source, '{0}:{1}'.format(BASELINE, path), 'exec'),
+         module.__dict__)
+    return module
+
+
+def measure(factory, count):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    objects = [factory(idx) for idx in range(count)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    # The list holding the objects is not part of their footprint
+    return (after-before-sys.getsizeof(objects))/float(len(objects))
+
+
+def build_block(count):
+    block = ExpressionBlock()
+    block.lines = [block.func('func_{0}'.format(idx % 16), idx % 256, 1)
+                   if idx % 2 else block.unknown(idx % 256, 2)
+                   for idx in range(count)]
+    return block
+
+
+def measure_table(count):
+    tracemalloc.start()
+    block = build_block(count)
+    objects = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del block
+    tracemalloc.start()
+    table = ExpressionTable()
+    table.add(build_block(count))
+    rows = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return objects/float(count), rows/float(count)
+
+
+def make_script(branches, operations=50):
+    def script(engine):
+        for idx in range(branches):
+            total = engine.vars.base
+            for step in range(operations):
+                total = total*engine.vars.scale+step
+            if engine.branch(total > idx):
+                engine.unknown(0x20, 2)
+        engine.unknown(0x40, 2)
+    return script
+
+
+def measure_replay(branches):
+    engine = Engine()
+    tracemalloc.start()
+    engine.compile(make_script(branches))
+    retained = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    refs = sum(len(var._refby or ()) for var in engine.vars._cache.values())
+    return engine.executions, refs, retained
+
+
+def main(count=100000, max_branches=8):
+    old_expression = load_baseline('compileengine/expression.py')
+    old_variable = load_baseline('compileengine/variable.py')
+    cases = [
+        ('Expression', lambda idx: old_expression.Expression('func', idx),
+         lambda idx: Expression('func', idx)),
+        ('UnknownExpression', old_expression.UnknownExpression,
+         UnknownExpression),
+        ('AssignmentExpression',
+         lambda idx: old_expression.AssignmentExpression(idx, 1),
+         lambda idx: AssignmentExpression(idx, 1)),
+        ('Variable', lambda idx: old_variable.Variable(value=idx),
+         lambda idx: Variable(value=idx)),
+    ]
+    for name, old_factory, new_factory in cases:
+        old = measure(old_factory, count)
+        new = measure(new_factory, count)
+        print('{0:>20}: {1:6.1f} -> {2:6.1f} bytes/object ({3:.0%})'.format(
+            name, old, new, new/old))
+    objects, rows = measure_table(count)
+    print('{0:>20}: {1:6.1f} -> {2:6.1f} bytes/expression ({3:.0%})'.format(
+        'ExpressionTable', objects, rows, rows/objects))
+    print('')
+    for branches in range(0, max_branches+1, 2):
+        executions, refs, retained = measure_replay(branches)
+        print('{0:>6} paths: {1:6} refs held, {2:8} bytes retained'.format(
+            executions, refs, retained))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,94 @@
+"""Compare linked image size and jump count with and without the block
+optimizer, and image size for sequential ifs with tail merging
+
+Usage: python benchmarks/bench_optimize.py [max_branches]
+"""
+import sys
+
+from compileengine.engine import Engine
+
+
+class OpcodeEngine(Engine):
+    # Jumps, branches and returns with one byte opcodes, like most targets
+    def write_branch(self, branch_state, condition):
+        if branch_state:
+            self.write_value(0xB0, 1)
+        return Engine.write_branch(self, branch_state, condition)
+
+    def write_jump(self):
+        self.write_value(0xA0, 1)
+        return Engine.write_jump(self)
+
+    def write_end(self, value):
+        self.write_value(0xFF, 1)
+
+
+def helper(engine):
+    engine.unknown(0x50, 2)
+
+
+def make_script(branches):
+    def script(engine):
+        engine.unknown(0x10, 2)
+        for idx in range(branches):
+            if engine.branch(engine.vars.flags > idx):
+                engine.unknown(0x20, 2)
+                engine.call(helper)
+            else:
+                engine.unknown(0x20, 2)
+                engine.call(helper)
+        while engine.loop(engine.vars.count > 0):
+            engine.vars.count -= 1
+        engine.unknown(0x40, 2)
+    return script
+
+
+def make_sequential_script(branches):
+    def script(engine):
+        for idx in range(branches):
+            if engine.branch(engine.vars.flags > idx):
+                engine.unknown(0x20, 2)
+            else:
+                engine.unknown(0x30, 2)
+            # Code after the join point
+            engine.unknown(0x60, 2)
+            engine.unknown(0x61, 2)
+        engine.unknown(0x40, 2)
+    return script
+
+
+def measure(engine_class, script, optimize, deduplicate=True):
+    engine = engine_class()
+    engine.optimize_blocks = optimize
+    engine.deduplicate_blocks = deduplicate
+    root = engine.compile(script)
+    image = engine.link(root)
+    blocks = engine.layout(root)
+    return len(image), len(blocks), sum(len(block.jumps) for block in blocks)
+
+
+def main(max_branches=8):
+    print('{0:>14} {1:>8} {2:>15} {3:>15} {4:>15}'.format(
+        'engine', 'branches', 'bytes', 'blocks', 'jumps'))
+    for engine_class in (Engine, OpcodeEngine):
+        for branches in range(0, max_branches+1, 2):
+            script = make_script(branches)
+            before = measure(engine_class, script, False)
+            after = measure(engine_class, script, True)
+            print('{0:>14} {1:>8} {2} {3} {4}'.format(
+                engine_class.__name__, branches,
+                *['{0:>7} ->{1:>5}'.format(old, new)
+                  for old, new in zip(before, after)]))
+    print('')
+    print('{0:>8} {1:>10} {2:>10} {3:>10}'.format(
+        'ifs', 'replayed', 'dedup', 'optimized'))
+    for branches in range(0, max_branches+1, 2):
+        script = make_sequential_script(branches)
+        print('{0:>8} {1:>10} {2:>10} {3:>10}'.format(
+            branches, measure(Engine, script, False, False)[0],
+            measure(Engine, script, False)[0],
+            measure(Engine, script, True, False)[0]))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
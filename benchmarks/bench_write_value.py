@@ -0,0 +1,49 @@
+"""Compare Engine.write_value against the previous byte-at-a-time writer
+
+Usage: python benchmarks/bench_write_value.py [count]
+"""
+import sys
+import timeit
+
+from compileengine.engine import Engine
+
+
+def legacy_write_value(engine, value, size=4):
+    # Byte-at-a-time concatenation, as write_value used to do it
+    buff = b''
+    for i in range(size):
+        buff += bytes(bytearray(((value >> (i*8)) & 0xFF, )))
+    engine.write(buff)
+
+
+def main(count=100000):
+    values = [(idx*2654435761) & 0xFFFFFFFF for idx in range(count)]
+
+    def run_legacy():
+        engine = Engine()
+        for value in values:
+            legacy_write_value(engine, value, 4)
+        return engine.getvalue()
+
+    def run_single():
+        engine = Engine()
+        for value in values:
+            engine.write_value(value, 4)
+        return engine.getvalue()
+
+    def run_batch():
+        engine = Engine()
+        engine.write_values(values, 4)
+        return engine.getvalue()
+
+    assert run_legacy() == run_single() == run_batch()
+    for name, func in (('legacy write_value', run_legacy),
+                       ('write_value', run_single),
+                       ('write_values', run_batch)):
+        elapsed = min(timeit.repeat(func, number=1, repeat=3))
+        print('{0:>20}: {1:8.2f} ms ({2:.0f} ns/value)'.format(
+            name, elapsed*1000, elapsed*1e9/count))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
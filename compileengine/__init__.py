@@ -1,6 +1,6 @@
 
-from decompiler import Decompiler
-from expression import Expression, ExpressionBlock
-from variable import Variable
+from compileengine.decompiler import Decompiler
+from compileengine.expression import Expression, ExpressionBlock
+from compileengine.variable import Variable
 
 __all__ = ['Decompiler', 'Expression', 'ExpressionBlock', 'Variable']
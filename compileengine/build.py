@@ -0,0 +1,237 @@
+
+import collections
+import types
+
+from compileengine.engine import Engine
+from compileengine.parallel import script_functions
+
+
+def function_key(func):
+    """Identify a function across reloads of its module
+
+    Returns
+    -------
+    key : (str, str)
+        Module and qualified name
+    """
+    return (getattr(func, '__module__', None),
+            getattr(func, '__qualname__', getattr(func, '__name__', None)))
+
+
+class ScriptDependencies(object):
+    """What one script used while it was compiled
+
+    Attributes
+    ----------
+    functions : set of (str, str)
+        `function_key` of the script and of every function it reached
+        through `Engine.call`, directly or through other calls
+    modules : set of str
+        Modules of those functions
+    names : dict
+        Map of collection kind ('vars' or 'funcs') to the set of names
+        used from it
+    """
+    def __init__(self, func):
+        self.functions = set()
+        self.modules = set()
+        self.names = collections.defaultdict(set)
+        self.add_function(func)
+
+    def add_function(self, func):
+        key = function_key(func)
+        self.functions.add(key)
+        self.modules.add(key[0])
+
+    def add_name(self, kind, name):
+        self.names[kind].add(name)
+
+    def update(self, other):
+        """Add everything `other` used
+        """
+        self.functions.update(other.functions)
+        self.modules.update(other.modules)
+        for kind, names in other.names.items():
+            self.names[kind].update(names)
+
+    def uses(self, functions=(), modules=(), names=()):
+        """Whether anything in the given sets was used
+
+        Parameters
+        ----------
+        functions : iterable of function or (str, str)
+        modules : iterable of module or str
+        names : iterable of (str, str)
+            (collection kind, name) pairs, like ('vars', 'flags')
+        """
+        for func in functions:
+            if not isinstance(func, tuple):
+                func = function_key(func)
+            if func in self.functions:
+                return True
+        for module in modules:
+            if isinstance(module, types.ModuleType):
+                module = module.__name__
+            if module in self.modules:
+                return True
+        for kind, name in names:
+            if name in self.names.get(kind, ()):
+                return True
+        return False
+
+
+class BuildSession(object):
+    """Compile a bundle of scripts into one image and keep it up to date
+
+    Each script is compiled on its own and linked into its own region of
+    the image, in name order. The session remembers the block graph and
+    dependencies of every script, so after a change only the scripts that
+    used something changed are compiled again, and only the regions whose
+    contents or addresses changed are linked again.
+
+    Attributes
+    ----------
+    engine : Engine
+        Engine reused for every script
+    base_address : int
+        Address the image is loaded at
+    scripts : OrderedDict
+        Map of script name to function
+    roots : dict
+        Map of script name to its entry block
+    dependencies : dict
+        Map of script name to its ScriptDependencies
+    regions : OrderedDict
+        Map of script name to its (start, stop) in `image`
+    image : bytearray
+        Linked bundle
+
+    Example
+    -------
+    >>> session = BuildSession(my_scripts)
+    >>> image = session.build()
+    >>> reload(my_helpers)
+    >>> changed = session.rebuild(modules=[my_helpers])
+    """
+    def __init__(self, scripts, engine_class=Engine, base_address=0):
+        self.engine = engine_class()
+        self.base_address = base_address
+        self.scripts = collections.OrderedDict(script_functions(scripts))
+        self.roots = {}
+        self.dependencies = {}
+        self.regions = collections.OrderedDict()
+        self.image = bytearray()
+
+    def compile_script(self, name):
+        """Compile script `name` and record what it uses
+        """
+        func = self.scripts[name]
+        engine = self.engine
+        engine.reset()
+        dependencies = ScriptDependencies(func)
+        engine.dependencies = dependencies
+        try:
+            self.roots[name] = engine.compile(func)
+        finally:
+            engine.dependencies = None
+        self.dependencies[name] = dependencies
+
+    def build(self):
+        """Compile and link every script
+
+        Returns
+        -------
+        image : bytearray
+        """
+        for name in self.scripts:
+            self.compile_script(name)
+        self.regions.clear()
+        self.link(set(self.scripts))
+        return self.image
+
+    def affected(self, functions=(), modules=(), names=()):
+        """Get the scripts that used any of the given functions, modules or
+        names. See `ScriptDependencies.uses`
+
+        Returns
+        -------
+        scripts : list of str
+        """
+        functions = list(functions)
+        modules = list(modules)
+        names = list(names)
+        return [name for name, dependencies in self.dependencies.items()
+                if dependencies.uses(functions, modules, names)]
+
+    def rebuild(self, functions=(), modules=(), names=(), scripts=None):
+        """Bring the image up to date after a change
+
+        Parameters
+        ----------
+        functions, modules, names
+            What changed. See `ScriptDependencies.uses`
+        scripts : module, dict or list, optional
+            New set of script functions, if scripts were added, removed or
+            reloaded. Scripts whose function object changed are recompiled
+
+        Returns
+        -------
+        changed : list of (int, int)
+            (start, stop) ranges of `image` that were rewritten
+        """
+        dirty = set(self.affected(functions, modules, names))
+        if scripts is not None:
+            scripts = collections.OrderedDict(script_functions(scripts))
+            for name, func in scripts.items():
+                if self.scripts.get(name) is not func:
+                    dirty.add(name)
+            for name in set(self.scripts)-set(scripts):
+                del self.roots[name]
+                del self.dependencies[name]
+            self.scripts = scripts
+        for name in self.scripts:
+            if name in dirty:
+                self.compile_script(name)
+        return self.link(dirty)
+
+    def link(self, dirty):
+        """Lay out the regions and link those that changed
+
+        A region is linked again if its script is in `dirty` or its start
+        moved. Other regions keep their bytes.
+
+        Returns
+        -------
+        changed : list of (int, int)
+            (start, stop) ranges of `image` that were rewritten
+        """
+        image = bytearray()
+        regions = collections.OrderedDict()
+        changed = []
+        for name in self.scripts:
+            start = len(image)
+            old = self.regions.get(name)
+            if name in dirty or old is None or old[0] != start:
+                data = self.engine.link(self.roots[name],
+                                        self.base_address+start)
+                unchanged = (old is not None and old[0] == start and
+                             self.image[old[0]:old[1]] == data)
+                if not unchanged:
+                    self._add_range(changed, start, start+len(data))
+            else:
+                data = self.image[old[0]:old[1]]
+            image += data
+            regions[name] = (start, len(image))
+        if len(image) < len(self.image):
+            # Scripts were removed or shrunk, so the end of the image changed
+            self._add_range(changed, len(image), len(self.image))
+        self.image = image
+        self.regions = regions
+        return changed
+
+    @staticmethod
+    def _add_range(ranges, start, stop):
+        if ranges and ranges[-1][1] == start:
+            ranges[-1] = (ranges[-1][0], stop)
+        else:
+            ranges.append((start, stop))
@@ -0,0 +1,346 @@
+
+import hashlib
+import os
+import pickle
+import struct
+import sys
+import sysconfig
+import tempfile
+import types
+
+from compileengine import serialize
+from compileengine.variable import Variable
+
+CACHE_VERSION = 1
+
+# Global values of these types are part of the key of any script using them
+PLAIN_TYPES = (bool, int, float, complex, str, bytes, type(None))
+
+replace = getattr(os, 'replace', os.rename)
+
+STDLIB_PATHS = tuple(os.path.normcase(os.path.abspath(path)) for path in
+                     set([sysconfig.get_paths()['stdlib'],
+                          sysconfig.get_paths()['platstdlib']]))
+SITE_PATHS = tuple(os.path.normcase(os.path.abspath(path)) for path in
+                   set([sysconfig.get_paths()['purelib'],
+                        sysconfig.get_paths()['platlib']]))
+
+
+def _is_stdlib(obj):
+    """Whether the function or class `obj` comes with the interpreter
+
+    These only change with the interpreter version, which is part of the
+    key, so they are hashed by name.
+    """
+    name = getattr(obj, '__module__', None)
+    path = getattr(sys.modules.get(name), '__file__', None)
+    if path is None:
+        return name in sys.builtin_module_names
+    path = os.path.normcase(os.path.abspath(path))
+    return (path.startswith(STDLIB_PATHS) and
+            not path.startswith(SITE_PATHS))
+
+
+def _feed(hasher, *parts):
+    for part in parts:
+        if not isinstance(part, bytes):
+            part = repr(part).encode('utf-8')
+        hasher.update(part)
+        hasher.update(b'\0')
+
+
+def _feed_const(hasher, const, func_globals, seen):
+    if isinstance(const, types.CodeType):
+        # Nested functions and lambdas share the globals of their parent
+        _feed_code(hasher, const, func_globals, seen)
+    elif isinstance(const, (tuple, frozenset)):
+        items = list(const)
+        if isinstance(const, frozenset):
+            items.sort(key=repr)
+        _feed(hasher, type(const).__name__, len(items))
+        for item in items:
+            _feed_const(hasher, item, func_globals, seen)
+    else:
+        _feed(hasher, const)
+
+
+def _feed_value(hasher, value, seen):
+    if isinstance(value, types.FunctionType):
+        _feed_function(hasher, value, seen)
+    elif isinstance(value, types.ModuleType):
+        _feed(hasher, 'module', value.__name__)
+    elif isinstance(value, PLAIN_TYPES):
+        _feed_const(hasher, value, None, seen)
+    elif id(value) in seen:
+        _feed(hasher, 'seen', seen[id(value)])
+    elif isinstance(value, type):
+        seen[id(value)] = len(seen)
+        if _is_stdlib(value):
+            _feed(hasher, 'class', value.__module__, value.__name__)
+        else:
+            _feed_class(hasher, value, seen)
+    elif isinstance(value, (tuple, list, set, frozenset, dict)):
+        # Containers are hashed by content, so editing a global such as
+        # CONFIG['debug'] changes the key
+        seen[id(value)] = len(seen)
+        _feed(hasher, type(value).__name__, len(value))
+        if isinstance(value, dict):
+            for key in sorted(value, key=repr):
+                _feed_value(hasher, key, seen)
+                _feed_value(hasher, value[key], seen)
+        else:
+            if isinstance(value, (set, frozenset)):
+                value = sorted(value, key=repr)
+            for item in value:
+                _feed_value(hasher, item, seen)
+    else:
+        seen[id(value)] = len(seen)
+        try:
+            data = pickle.dumps(value, 2)
+        except Exception:
+            # Process resources such as locks, files or compiled structs
+            data = b''
+        _feed(hasher, type(value).__name__, data)
+
+
+def _feed_code(hasher, code, func_globals, seen):
+    _feed(hasher, code.co_code, code.co_names, code.co_varnames,
+          code.co_freevars)
+    for const in code.co_consts:
+        _feed_const(hasher, const, func_globals, seen)
+    if func_globals is None:
+        return
+    modules = []
+    for name in code.co_names:
+        try:
+            value = func_globals[name]
+        except KeyError:
+            continue
+        _feed(hasher, name)
+        _feed_value(hasher, value, seen)
+        if isinstance(value, types.ModuleType):
+            modules.append(value)
+    # Attributes such as helpers.h2 are looked up by name in the module
+    for module in modules:
+        namespace = vars(module)
+        for name in code.co_names:
+            try:
+                value = namespace[name]
+            except KeyError:
+                continue
+            _feed(hasher, module.__name__, name)
+            _feed_value(hasher, value, seen)
+            if (isinstance(value, types.ModuleType) and
+                    value not in modules):
+                modules.append(value)
+
+
+def _feed_function(hasher, func, seen):
+    if id(func) in seen:
+        _feed(hasher, 'seen', seen[id(func)])
+        return
+    seen[id(func)] = len(seen)
+    _feed(hasher, func.__module__, func.__name__)
+    if _is_stdlib(func):
+        return
+    _feed_code(hasher, func.__code__, func.__globals__, seen)
+    for cell in func.__closure__ or ():
+        try:
+            _feed_value(hasher, cell.cell_contents, seen)
+        except ValueError:
+            # Empty cell
+            _feed(hasher, 'empty')
+    for default in func.__defaults__ or ():
+        _feed_value(hasher, default, seen)
+
+
+def _feed_variable(hasher, value):
+    """Feed a variable value without the ids of unnamed variables
+    """
+    if isinstance(value, Variable):
+        if value.name is not None:
+            _feed(hasher, 'var', value.name)
+        else:
+            _feed(hasher, 'tmp', value.const)
+            _feed_variable(hasher, value.value)
+    elif isinstance(value, tuple):
+        _feed(hasher, 'tuple', len(value))
+        for item in value:
+            _feed_variable(hasher, item)
+    elif callable(value):
+        _feed(hasher, getattr(value, '__name__', repr(value)))
+    else:
+        _feed(hasher, value)
+
+
+def _feed_class(hasher, cls, seen):
+    """Feed the methods and plain attributes of `cls` and its bases
+    """
+    for klass in cls.__mro__:
+        if klass is object:
+            continue
+        _feed(hasher, klass.__module__, klass.__name__)
+        namespace = vars(klass)
+        for name in sorted(namespace):
+            value = namespace[name]
+            if isinstance(value, (staticmethod, classmethod)):
+                value = value.__func__
+            elif isinstance(value, property):
+                value = value.fget
+            if (isinstance(value, types.FunctionType) or
+                    isinstance(value, PLAIN_TYPES)):
+                _feed(hasher, name)
+                _feed_value(hasher, value, seen)
+
+
+def script_key(engine, func):
+    """Get the cache key of compiling `func` with `engine`
+
+    The key covers the function's bytecode, constants, names, closure, and
+    the functions and plain values it reaches through its globals or
+    through attributes of modules in its globals (which includes anything
+    it passes to `Engine.call`). Nested functions are hashed with the
+    globals of the function they are defined in. The methods and plain
+    attributes of the engine class and its bases, and of the optimizer when
+    it is on, are covered too. Functions and classes of the standard
+    library are only hashed by name, with the interpreter version. So are the variables already set on
+    `engine.vars`, since the script starts from them.
+
+    Other global values are hashed by content: containers item by item,
+    anything else through pickle. Values that cannot be pickled, like
+    locks and open files, only contribute their type.
+
+    Returns
+    -------
+    key : str
+        Hex digest
+    """
+    hasher = hashlib.sha1()
+    seen = {}
+    _feed(hasher, CACHE_VERSION, sys.version_info[:3], engine.pointer_size, engine.byteorder,
+          engine.deduplicate_blocks, engine.memoize_calls,
+          engine.prune_branches, engine.optimize_blocks)
+    _feed_class(hasher, type(engine), seen)
+    for name, var in sorted(engine.vars._cache.items()):
+        _feed(hasher, name, var.const)
+        _feed_variable(hasher, var.value)
+    if engine.optimize_blocks:
+        optimizer = engine.optimizer_class
+        _feed_class(hasher, optimizer, seen)
+        for rule in optimizer.rules:
+            _feed_class(hasher, rule if isinstance(rule, type)
+                        else type(rule), seen)
+    _feed_function(hasher, func, seen)
+    return hasher.hexdigest()
+
+
+class CompileCache(object):
+    """Persistent on-disk cache of compiled scripts
+
+    Entries are stored one per file, written atomically, and evicted least
+    recently used first once the directory grows past `max_size`.
+
+    Attributes
+    ----------
+    directory : str
+        Directory holding the cache entries
+    max_size : int
+        Number of bytes the entries may use in total
+
+    Example
+    -------
+    >>> cache = CompileCache('.script-cache')
+    >>> block = cache.compile(MyEngine(), my_script)
+    """
+    suffix = '.blocks'
+
+    def __init__(self, directory, max_size=64 << 20):
+        self.directory = directory
+        self.max_size = max_size
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, key):
+        return os.path.join(self.directory, key+self.suffix)
+
+    def get(self, key):
+        """Get the stored data for `key`, or None if it is not cached
+        """
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as handle:
+                data = handle.read()
+        except IOError:
+            return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return data
+
+    def put(self, key, data):
+        """Store `data` for `key` and evict old entries if needed
+        """
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as handle:
+                handle.write(data)
+            replace(temp_path, self.path(key))
+        except:
+            os.remove(temp_path)
+            raise
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until under `max_size`
+        """
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith(self.suffix):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+    def remove(self, key):
+        """Remove the entry for `key`, if there is one
+        """
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass
+
+    def compile(self, engine, func):
+        """Compile `func` with `engine`, or load it if it is cached
+
+        A corrupt entry is removed and the script is compiled again.
+
+        Returns
+        -------
+        block : EngineBlock
+            Entry block of the script
+        """
+        key = script_key(engine, func)
+        data = self.get(key)
+        if data is not None:
+            try:
+                return serialize.loads(engine, data)
+            except (serialize.FormatError, struct.error, IndexError):
+                self.remove(key)
+        root_block = engine.compile(func)
+        self.put(key, serialize.dumps(engine, root_block))
+        return root_block
@@ -1,5 +1,11 @@
 
-from expression import ExpressionBlock
+import struct
+
+from compileengine.engine import (BYTEORDER_PREFIXES, VALUE_FORMATS,
+                                  VALUE_STRUCTS)
+from compileengine.expression import ExpressionBlock
+from compileengine.ir import ExpressionTable
+from compileengine.passes import PassManager
 
 
 class Decompiler(ExpressionBlock):
@@ -14,6 +20,15 @@ class Decompiler(ExpressionBlock):
         Location parsing begins. Defaults to handle.tell()
     stop : int or None
         If specified, parsing will forcibly stop once this byte is reached
+    byteorder : str
+        Byte order of values. 'little' or 'big'
+    targets : list
+        Offsets of other scripts referenced while parsing. See `target`
+    passes : list
+        Pass classes or instances run by `simplify`. See
+        `compileengine.passes.PassManager`
+    pass_stats : OrderedDict or None
+        Statistics of the passes from the last `simplify`
 
     Methods
     -------
@@ -25,15 +40,34 @@ class Decompiler(ExpressionBlock):
     compileengine.expression.ExpressionBlock
     compileengine.expression.ExpressionIterator
     """
+    byteorder = 'little'
+    passes = ()
+    pass_stats = None
+
     def __init__(self, handle):
         ExpressionBlock.__init__(self)
         self.handle = handle
         self.start = handle.tell()
         self.stop = None
+        self.targets = []
 
     def reset(self):
         self.handle.seek(self.start)
         self.lines = []
+        self.targets = []
+
+    def target(self, offset):
+        """Record that the script at `offset` is jumped to or called
+
+        Derived classes should call this instead of parsing the target
+        themselves, so that a FunctionTable can decode it once.
+
+        Returns
+        -------
+        offset : int
+        """
+        self.targets.append(offset)
+        return offset
 
     def read(self, size=None):
         """Read from the handle
@@ -50,16 +84,27 @@ class Decompiler(ExpressionBlock):
         size : int
             Width in bytes of the returned datatype
         """
+        data = bytearray(self.read(size))
+        if not data:
+            return None
+        if self.byteorder == 'big':
+            data.reverse()
         value = 0
         shift = 0
-        char = None
-        for char in self.read(size):
-            value += ord(char) << shift
+        for char in data:
+            value += char << shift
             shift += 8
-        if char is None:
-            return None
         return value
 
+    def read_values(self, count, size=4):
+        """Read `count` consecutive values of `size` bytes each
+
+        Returns
+        -------
+        values : list of int
+        """
+        return [self.read_value(size) for idx in range(count)]
+
     def tell(self):
         """Get position of handle
         """
@@ -113,4 +158,320 @@ class Decompiler(ExpressionBlock):
         parsed : list
             Simplified list of expressions
         """
+        if not self.passes:
+            return parsed
+        manager = PassManager(self.passes)
+        parsed = manager.run(parsed)
+        self.pass_stats = manager.stats
         return parsed
+
+
+class BufferDecompiler(Decompiler):
+    """Decompiler that reads directly from a buffer instead of a file handle
+
+    Any object supporting the buffer protocol works, including bytes,
+    bytearray, memoryview and mmap. Reads do not copy: `read` returns a
+    memoryview into the buffer, and values are decoded in place.
+
+    Attributes
+    ----------
+    buffer : memoryview
+        View over the whole buffer. Release it before closing an mmap
+    position : int
+        Current read offset in `buffer`
+
+    Example
+    -------
+    >>> with open('rom.bin', 'rb') as handle:
+    ...     data = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+    >>> decompiler = BufferDecompiler(data, 0x1000)
+    >>> decompiler.parse()
+    """
+    def __init__(self, buff, start=0):
+        ExpressionBlock.__init__(self)
+        self.handle = None
+        self.buffer = memoryview(buff)
+        self.position = start
+        self.start = start
+        self.stop = None
+        self.targets = []
+
+    def reset(self):
+        self.position = self.start
+        self.lines = []
+        self.targets = []
+
+    def read(self, size=None):
+        """Read a view of the next `size` bytes
+        """
+        if size is None:
+            end = len(self.buffer)
+        else:
+            end = min(self.position+size, len(self.buffer))
+        data = self.buffer[self.position:end]
+        self.position = end
+        return data
+
+    def read_value(self, size=None):
+        try:
+            value, = VALUE_STRUCTS[self.byteorder, size].unpack_from(
+                self.buffer, self.position)
+        except (KeyError, struct.error):
+            # Unusual width or truncated value
+            return Decompiler.read_value(self, size)
+        self.position += size
+        return value
+
+    def read_values(self, count, size=4):
+        try:
+            fmt = '{0}{1}{2}'.format(BYTEORDER_PREFIXES[self.byteorder],
+                                     count, VALUE_FORMATS[size])
+            values = struct.unpack_from(fmt, self.buffer, self.position)
+        except (KeyError, struct.error):
+            return Decompiler.read_values(self, count, size)
+        self.position += count*size
+        return list(values)
+
+    def tell(self):
+        return self.position
+
+    def seek(self, ofs, whence=0):
+        if whence == 1:
+            ofs += self.position
+        elif whence == 2:
+            ofs += len(self.buffer)
+        self.position = ofs
+        return ofs
+
+
+class BasicBlock(object):
+    """Lines decoded from a run of bytes that is only entered at its start
+
+    Attributes
+    ----------
+    start : int
+        Offset of the first instruction
+    end : int
+        Offset just past the last instruction
+    instructions : list of (int, list, list)
+        Offset, parsed lines and recorded targets of each `parse_next`
+        call
+    next : int or None
+        Offset of the block that follows when the last instruction falls
+        through, or None if the block returns or stops
+    """
+    def __init__(self, start):
+        self.start = start
+        self.end = start
+        self.instructions = []
+        self.next = None
+
+    @property
+    def lines(self):
+        return [line for offset, lines, targets in self.instructions
+                for line in lines]
+
+    @property
+    def targets(self):
+        return [target for offset, lines, targets in self.instructions
+                for target in targets]
+
+    def split(self, offset):
+        """Move the instructions from `offset` on into a new block
+
+        This block falls through into the new one.
+
+        Returns
+        -------
+        block : BasicBlock
+        """
+        for idx, instruction in enumerate(self.instructions):
+            if instruction[0] == offset:
+                break
+        else:
+            raise ValueError('No instruction at {0:#x}'.format(offset))
+        block = BasicBlock(offset)
+        block.instructions = self.instructions[idx:]
+        block.end = self.end
+        block.next = self.next
+        del self.instructions[idx:]
+        self.end = offset
+        self.next = offset
+        return block
+
+
+class FunctionTable(object):
+    """Decompile scripts reachable from a set of entry points, decoding
+    each instruction only once
+
+    Like a disassembler's function table, this keeps a cache of basic
+    blocks by offset. Decoding a block stops when it reaches bytes that
+    were already decoded, and a target that lands inside a block splits
+    it there, so scripts that share code share its blocks. Offsets
+    recorded with `Decompiler.target` are added to a worklist instead of
+    being parsed recursively.
+
+    Each entry is a decompiler holding the lines of the blocks from its
+    offset on, so it reads the same as a linear `Decompiler.parse` from
+    there.
+
+    Attributes
+    ----------
+    source : readable or buffer
+        File handle, or buffer if `decompiler_class` is a BufferDecompiler
+    decompiler_class : type
+        Decompiler class used for every script
+    entries : dict
+        Map of entry offset to its decompiler
+    blocks : dict
+        Map of block start offset to its BasicBlock
+    owners : dict
+        Map of instruction offset to the BasicBlock holding it
+
+    Example
+    -------
+    >>> table = FunctionTable(data, MyDecompiler)
+    >>> table.decompile(0x1000, 0x2000)
+    >>> print(table[0x1000])
+    """
+    def __init__(self, source, decompiler_class=BufferDecompiler):
+        self.source = source
+        self.decompiler_class = decompiler_class
+        self.entries = {}
+        self.blocks = {}
+        self.owners = {}
+
+    def create(self, offset):
+        """Create an unparsed decompiler starting at `offset`
+        """
+        if issubclass(self.decompiler_class, BufferDecompiler):
+            return self.decompiler_class(self.source, offset)
+        self.source.seek(offset)
+        return self.decompiler_class(self.source)
+
+    def block(self, offset):
+        """Get the basic block starting at `offset`
+
+        A block holding `offset` is split, and otherwise a new block is
+        decoded.
+
+        Returns
+        -------
+        block : BasicBlock
+        """
+        try:
+            owner = self.owners[offset]
+        except KeyError:
+            return self.decode(offset)
+        if owner.start == offset:
+            return owner
+        block = owner.split(offset)
+        self.blocks[offset] = block
+        for instruction in block.instructions:
+            self.owners[instruction[0]] = block
+        return block
+
+    def decode(self, offset):
+        """Decode a new basic block at `offset`
+
+        Returns
+        -------
+        block : BasicBlock
+        """
+        decompiler = self.create(offset)
+        decompiler.prepare()
+        block = BasicBlock(offset)
+        self.blocks[offset] = block
+        while True:
+            position = decompiler.tell()
+            if position in self.owners:
+                # The rest was decoded before
+                block.next = self.block(position).start
+                break
+            if decompiler.stop is not None and position >= decompiler.stop:
+                break
+            count = len(decompiler.targets)
+            lines = decompiler.parse_next()
+            block.instructions.append(
+                (position, lines, decompiler.targets[count:]))
+            self.owners[position] = block
+            if lines and lines[-1].is_return():
+                break
+        block.end = decompiler.tell()
+        return block
+
+    def assemble(self, offset):
+        """Build the decompiler of the entry at `offset` from its blocks
+
+        Returns
+        -------
+        decompiler : Decompiler
+        """
+        decompiler = self.create(offset)
+        lines = []
+        seen = set()
+        block = self.blocks[offset]
+        while block.start not in seen:
+            seen.add(block.start)
+            lines += block.lines
+            decompiler.targets += block.targets
+            if block.next is None:
+                break
+            block = self.blocks[block.next]
+        decompiler.lines = decompiler.simplify(lines)
+        return decompiler
+
+    def decompile(self, *offsets):
+        """Parse every script reachable from `offsets`
+
+        Returns
+        -------
+        decompilers : list
+            Parsed decompilers for `offsets`, in order
+        """
+        worklist = list(offsets)
+        found = set()
+        while worklist:
+            offset = worklist.pop()
+            if offset in self.entries or offset in found:
+                continue
+            found.add(offset)
+            decoded = offset not in self.owners
+            block = self.block(offset)
+            if decoded:
+                worklist.extend(block.targets)
+        # Blocks may have been split until now, so entries are built last
+        for offset in found:
+            self.entries[offset] = self.assemble(offset)
+        return [self.entries[offset] for offset in offsets]
+
+    def expression_table(self, table=None):
+        """Store every parsed script in an ExpressionTable
+
+        Parameters
+        ----------
+        table : ExpressionTable, optional
+            Table to add to. A new one is created by default
+
+        Returns
+        -------
+        table : ExpressionTable
+            Table with the root of each script in `roots`, keyed by offset
+        """
+        if table is None:
+            table = ExpressionTable()
+        for offset in sorted(self.entries):
+            table.add(self.entries[offset], offset)
+        return table
+
+    def __getitem__(self, offset):
+        try:
+            return self.entries[offset]
+        except KeyError:
+            return self.decompile(offset)[0]
+
+    def __contains__(self, offset):
+        return offset in self.entries
+
+    def __len__(self):
+        return len(self.entries)
@@ -1,17 +1,28 @@
 
+import hashlib
+import io
 import itertools
+import numbers
+import os
+import pickle
+import struct
+import sys
+import traceback
 
-try:
-    from io import BytesIO
-    binary_type = bytes
-except:
-    from StringIO import StringIO as BytesIO
-    binary_type = str
-
+from compileengine.optimize import BlockOptimizer
 from compileengine.variable import Variable
 
+VALUE_FORMATS = {1: 'B', 2: 'H', 4: 'I', 8: 'Q'}
+BYTEORDER_PREFIXES = {'little': '<', 'big': '>'}
+VALUE_STRUCTS = dict(
+    ((byteorder, size), struct.Struct(prefix+fmt))
+    for byteorder, prefix in BYTEORDER_PREFIXES.items()
+    for size, fmt in VALUE_FORMATS.items())
+
 
 class VariableCollection(object):
+    kind = 'vars'
+
     def __init__(self, engine, inst_class):
         object.__setattr__(self, '_cache', {})
         object.__setattr__(self, 'engine', engine)
@@ -21,6 +32,8 @@ class VariableCollection(object):
         var = self._inst_class()
         var.name = name
         var.engine = self.engine
+        if self.engine.dependencies is not None:
+            self.engine.dependencies.add_name(self.kind, name)
         return var
 
     def __getattr__(self, name):
@@ -34,30 +47,45 @@ class VariableCollection(object):
     def __setattr__(self, name, value):
         var = getattr(self, name)
         var.value = value
+        if self.engine.loop_stack:
+            # Later iterations may see a different value
+            var.const = False
+            self.engine.loop_stack[-1].assigned.add(name)
+        else:
+            var.const = True
 
     def __dir__(self):
         return self._cache.keys()
 
+    def _snapshot(self):
+        return dict((name, (var.value, var.const))
+                    for name, var in self._cache.items())
+
+    def _restore(self, snapshot):
+        for name, var in self._cache.items():
+            var.value, var.const = snapshot.get(name, (None, True))
+            var.release_refs()
+
 
 class Function(Variable):
     """Function
 
     This variable type is callable
     """
+    __slots__ = ()
+
     def __call__(self, *args):
         # self.engine.func(self, *args)
         return
 
 
 class FunctionCollection(VariableCollection):
+    kind = 'funcs'
+
     def __setattr__(self, name, value):
         raise TypeError('Cannot set a function')
 
 
-class NewBranch(Exception):
-    pass
-
-
 class EngineBlock(object):
     """Stored compiled block
 
@@ -65,67 +93,314 @@ class EngineBlock(object):
     ----------
     engine : Engine
         Reference to parent engine
-    buff : str
-        Value of block
+    buff : bytearray
+        Value of block. This is only appended to while the block is emitted
     jumps : dict
         Map of offset (relative to block start) to another block
+    kinds : dict
+        Map of offset (relative to block start) to the kind of jump. One of
+        KIND_JUMP, KIND_BRANCH or KIND_CALL
     offset : int, optional
         Determined offset of block
+    complete : bool
+        Whether `buff` has been fully emitted
+    marks : list
+        Offsets where instructions start. See `Engine.mark`
     """
+    KIND_JUMP = 0
+    KIND_BRANCH = 1
+    KIND_CALL = 2
+
     def __init__(self, engine):
         self.engine = engine
-        self.buff = None
+        self.buff = bytearray()
         self.jumps = {}
+        self.kinds = {}
         self.offset = -1
+        self.complete = False
+        self.marks = []
+        self._digest = None
+
+    def add_jump(self, ofs, block, kind=KIND_JUMP):
+        """Point the slot at `ofs` to `block`
+
+        Parameters
+        ----------
+        ofs : int
+            Offset of the pointer slot relative to the start of this block
+        block : EngineBlock
+            Target block
+        kind : int
+            KIND_JUMP, KIND_BRANCH or KIND_CALL
+        """
+        self.jumps[ofs] = block
+        self.kinds[ofs] = kind
+        path_fork = self.engine.path_fork
+        if path_fork is not None:
+            path_fork.touched.append(self)
+
+    def splice(self, start, stop, data=b'', jumps=(), marks=()):
+        """Replace `buff[start:stop]` with `data`
+
+        Jump slots and marks inside the replaced range are dropped, and the
+        ones after it are moved with the bytes that follow. `start` is
+        marked, since `data` begins an instruction.
+
+        Parameters
+        ----------
+        start : int
+        stop : int
+        data : bytes
+            New bytes
+        jumps : iterable of (int, EngineBlock, int)
+            (offset relative to `start`, target, kind) of the slots in
+            `data`
+        marks : iterable of int
+            Marks in `data`, relative to `start`
+        """
+        delta = len(data)-(stop-start)
+        self.marks = sorted(set(
+            [mark for mark in self.marks if mark < start] +
+            [mark+delta for mark in self.marks if mark >= stop] +
+            [start+mark for mark in marks] + [start]))
+        old_jumps = self.jumps
+        old_kinds = self.kinds
+        self.jumps = {}
+        self.kinds = {}
+        for ofs, target in old_jumps.items():
+            if ofs < start:
+                self.add_jump(ofs, target, old_kinds.get(ofs, self.KIND_JUMP))
+            elif ofs >= stop:
+                self.add_jump(ofs+delta, target,
+                              old_kinds.get(ofs, self.KIND_JUMP))
+        for ofs, target, kind in jumps:
+            self.add_jump(start+ofs, target, kind)
+        self.buff[start:stop] = data
+        self._digest = None
+
+    def masked(self):
+        """Get the value of this block with every jump slot zeroed
+        """
+        buff = bytearray(self.buff)
+        blank = bytearray(self.engine.pointer_size)
+        for ofs in self.jumps:
+            buff[ofs:ofs+len(blank)] = blank
+        return bytes(buff)
+
+    def digest(self):
+        """Structural hash of this block
+
+        This covers the block's bytes with the jump slots masked, the jump
+        offsets and the digests of the jump targets. Jumps back to a block
+        that is still being hashed are recorded by how far up they point.
+
+        Returns
+        -------
+        digest : bytes
+        """
+        if self._digest is not None:
+            return self._digest
+        depths = {id(self): 0}
+        # Frames are [block, targets, parts, shallowest back reference]
+        frames = [[self, sorted(self.jumps.items()), [], 0]]
+        while True:
+            frame = frames[-1]
+            block, targets, parts, escape = frame
+            if len(parts) < len(targets):
+                ofs, target = targets[len(parts)]
+                if target._digest is not None:
+                    parts.append((ofs, target._digest))
+                elif id(target) in depths:
+                    depth = depths[id(target)]
+                    distance = len(frames)-1-depth
+                    parts.append((ofs, b'back'+struct.pack('<I', distance)))
+                    frame[3] = min(escape, depth)
+                else:
+                    depths[id(target)] = len(frames)
+                    frames.append([target, sorted(target.jumps.items()), [],
+                                   len(frames)])
+                continue
+            hasher = hashlib.sha1(block.masked())
+            for ofs, part in parts:
+                hasher.update(struct.pack('<IB', ofs,
+                                          block.kinds.get(ofs, 0)))
+                hasher.update(part)
+            digest = hasher.digest()
+            frames.pop()
+            del depths[id(block)]
+            if not frames:
+                if block.complete:
+                    block._digest = digest
+                return digest
+            # Blocks inside a cycle hash differently depending on where
+            # hashing started, so only blocks hashed as a whole are cached
+            if escape >= len(frames) and block.complete:
+                block._digest = digest
+            parent = frames[-1]
+            parent_ofs = parent[1][len(parent[2])][0]
+            parent[2].append((parent_ofs, digest))
+            parent[3] = min(parent[3], escape)
 
     def __eq__(self, other):
         if self is other:
             return True
-        if len(self.buff) != len(other.buff):
+        if not isinstance(other, EngineBlock):
             return False
-        idx = 0
-        while idx < len(self.buff):
-            if idx in self.jumps:
-                if idx not in other.jumps:
-                    return False
-                if self.jumps[idx] != other.jumps[idx]:
-                    return False
-                idx += self.engine.pointer_size
-                continue
-            byte1 = self.buff[idx]
-            byte2 = other.buff[idx]
-            if byte1 != byte2:
-                return False
-            idx += 1
-        return True
+        return self.digest() == other.digest()
 
     def __ne__(self, other):
         return not self.__eq__(other)
 
+    def __hash__(self):
+        return hash(self.digest())
+
+
+class EngineLoop(object):
+    """State of a loop whose body is being run
+
+    Attributes
+    ----------
+    site : tuple
+        Frame and line of the `Engine.loop` call
+    header : EngineBlock
+        Block that tests the condition. The body jumps back here
+    exit_ofs : int
+        Offset of the header's False slot
+    depth : int
+        Length of the engine's block stack inside the header
+    consts : dict
+        Map of variable name to its `const` flag before the loop
+    assigned : set
+        Names of variables assigned inside the loop
+    """
+    def __init__(self, site, depth, consts):
+        self.site = site
+        self.header = None
+        self.exit_ofs = None
+        self.depth = depth
+        self.consts = consts
+        self.assigned = set()
+
+
+class EngineFork(object):
+    """What a child process forked at a decision needs to report back
 
-class Engine(BytesIO):
+    The child follows the True side of the decision while its parent
+    waits. When the child's path ends, every block it wrote, and the state
+    and subroutine entries it added, are sent to the parent, which then
+    follows the False side from where it stopped.
+
+    Attributes
+    ----------
+    block_count : int
+        Length of the engine's block list at the fork
+    path_count : int
+        Length of the engine's path list at the fork
+    open_blocks : list of EngineBlock
+        Blocks that were still being written at the fork
+    shared : dict
+        Map of id to the objects on the path stack at the fork. These are
+        sent by id, since both processes hold them
+    touched : list of EngineBlock
+        Blocks whose jumps the child changed
+    states : list of tuple
+        Keys the child added to `Engine.state_blocks`
+    calls : list of tuple
+        Keys the child added to `Engine.subroutines`
+    fd : int or None
+        Write end of the pipe to the parent. Only set in the child
+    """
+    def __init__(self, engine):
+        self.block_count = len(engine.blocks)
+        self.path_count = len(engine.paths)
+        self.open_blocks = [engine.current_block]+engine.stack
+        self.shared = dict(
+            (id(state), state) for state in engine.path_stack
+            if not isinstance(state, (bool, tuple)))
+        self.touched = []
+        self.states = []
+        self.calls = []
+        self.fd = None
+
+
+class Engine(object):
     """Execute a decompiled function with this object to compile it
+
+    The engine behaves as a writable file over the current block. Every
+    EngineBlock owns its buffer, so moving between blocks does not copy
+    any bytes, and `tell()` is always relative to the current block.
     """
     variable_collection_class = VariableCollection
     function_collection_class = FunctionCollection
     variable_class = Variable
     function_class = Function
+    optimizer_class = BlockOptimizer
     pointer_size = 4
+    byteorder = 'little'
+    deduplicate_blocks = True
+    memoize_calls = False
+    prune_branches = False
+    optimize_blocks = False
+    fork_paths = False
 
     STATE_IDLE = 0
-    STATE_BUILDING_BRANCHES = 1
     STATE_COMPILING = 2
 
     def __init__(self):
-        BytesIO.__init__(self)
+        self.reset()
+
+    def reset(self):
+        """Discard all variables and compiled blocks
+
+        This returns the engine to the state of a new engine, so one engine
+        can compile many scripts.
+        """
+        # Set by a BuildSession to record what a script uses
+        self.dependencies = None
         self.vars = self._init_vars()
         self.funcs = self._init_funcs()
         self.state = self.STATE_IDLE
         self.stack = []
-        self.current_block = None
+        self.offset_stack = []
+        self.current_block = EngineBlock(self)
+        self.position = 0
         self.state_blocks = {}
         self.path_stack = []
         self.blocks = []
+        self.block_table = {}
+        self.subroutines = {}
+        self.subroutine_depth = 0
+        self.pruned_branches = 0
+        self.loop_id = 0
+        self.loop_stack = []
+        self.path_fork = None
+        self.forks = 0
+
+    def pack_value(self, value, size=4):
+        """Get the bytes for a fixed length value
+
+        Values are masked to `size` bytes, so negative values are written
+        as two's complement.
+
+        Parameters
+        ----------
+        value : int
+            Unsigned value to pack
+        size : int
+            Number of bytes that value should occupy
+
+        Returns
+        -------
+        buff : bytes
+        """
+        value &= (1 << (size*8))-1
+        try:
+            return VALUE_STRUCTS[self.byteorder, size].pack(value)
+        except KeyError:
+            buff = bytearray((value >> (i*8)) & 0xFF for i in range(size))
+            if self.byteorder == 'big':
+                buff.reverse()
+            return bytes(buff)
 
     def write_value(self, value, size=4):
         """Write a fixed length value to the buffer
@@ -137,39 +412,100 @@ class Engine(BytesIO):
         size : int
             Number of bytes that value should occupy
         """
-        buff = binary_type()
-        for i in range(size):
-            buff += chr((value >> (i*8)) & 0xFF)
-        self.write(buff)
+        self.write(self.pack_value(value, size))
 
-    def reset(self):
-        self.truncate(0)
-        self.seek(0)
+    def write_values(self, values, size=4):
+        """Write a sequence of fixed length values to the buffer at once
 
-    def push(self, state=None):
+        Parameters
+        ----------
+        values : list of int
+            Unsigned values to write
+        size : int
+            Number of bytes that each value should occupy
+        """
+        mask = (1 << (size*8))-1
+        values = [value & mask for value in values]
+        try:
+            fmt = '{0}{1}{2}'.format(BYTEORDER_PREFIXES[self.byteorder],
+                                     len(values), VALUE_FORMATS[size])
+        except KeyError:
+            self.write(b''.join(self.pack_value(value, size)
+                                for value in values))
+            return
+        self.write(struct.pack(fmt, *values))
+
+    def write(self, data):
+        """Write bytes to the current block at the current position
+
+        Writes to a complete block only move the position. This keeps `tell`
+        accurate while a later path replays code that was already emitted.
+        Like BytesIO, writing past the end pads the gap with zeros.
+        """
         block = self.current_block
-        block.buff = self.getvalue()
-        self.truncate(0)
-        self.seek(0)
-        self.stack.append(block)
+        end = self.position+len(data)
+        if not block.complete:
+            buff = block.buff
+            if self.position > len(buff):
+                buff.extend(bytearray(self.position-len(buff)))
+            buff[self.position:end] = data
+        self.position = end
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def seek(self, ofs, whence=0):
+        if whence == 1:
+            ofs += self.position
+        elif whence == 2:
+            ofs += len(self.current_block.buff)
+        self.position = ofs
+        return ofs
+
+    def truncate(self, size=None):
+        if size is None:
+            size = self.position
+        block = self.current_block
+        if not block.complete:
+            del block.buff[size:]
+        return size
+
+    def getvalue(self):
+        return bytes(self.current_block.buff)
+
+    def push(self, state=None, block=None):
+        self.stack.append(self.current_block)
+        self.offset_stack.append(self.position)
         if state is None:
             state = object()
         self.path_stack.append(state)
-        try:
-            self.current_block = self.state_blocks[tuple(self.path_stack)]
-        except KeyError:
-            self.current_block = EngineBlock(self)
-            self.blocks.append(self.current_block)
-            self.state_blocks[tuple(self.path_stack)] = self.current_block
+        if block is not None:
+            self.current_block = block
+        else:
+            try:
+                self.current_block = self.state_blocks[tuple(self.path_stack)]
+            except KeyError:
+                self.current_block = EngineBlock(self)
+                self.blocks.append(self.current_block)
+                key = tuple(self.path_stack)
+                self.state_blocks[key] = self.current_block
+                if self.path_fork is not None:
+                    self.path_fork.states.append(key)
+        self.position = 0
 
     def pop(self):
-        self.current_block.buff = self.getvalue()
-        block = self.stack.pop()
+        self.finish_block()
+        self.current_block = self.stack.pop()
+        self.position = self.offset_stack.pop()
         self.path_stack.pop()
-        self.current_block = block
-        self.truncate(0)
-        self.seek(0)
-        self.write(block.buff)
+
+    def finish_block(self):
+        """Mark the current block as complete.
+
+        Later paths that pass through a complete block do not emit it again.
+        """
+        self.current_block.complete = True
 
     def _init_vars(self):
         return self.variable_collection_class(self, self.variable_class)
@@ -177,47 +513,236 @@ class Engine(BytesIO):
     def _init_funcs(self):
         return self.function_collection_class(self, self.function_class)
 
+    def mark(self):
+        """Record that an instruction starts at the current position
+
+        The engine marks each instruction it writes itself. Derived classes
+        should call this at the start of each of their own instructions, as
+        blocks are only ever split at marks. See `BlockOptimizer.merge_tails`
+        """
+        if not self.current_block.complete:
+            self.current_block.marks.append(self.position)
+
     def write_end(self, value):
         return
 
     def compile(self, func):
+        """Compile `func` into a graph of EngineBlocks
+
+        Paths are discovered and emitted in the same pass. Each execution
+        of `func` follows one complete path, and every block is produced by
+        the first path that reaches it. With `fork_paths`, `func` runs once
+        and each path resumes from a forked copy of the process instead.
+        See `_explore`
+
+        Returns
+        -------
+        block : EngineBlock
+            Entry block of the script
+        """
         try:
-            self.state = self.STATE_BUILDING_BRANCHES
-            self._find_branches(func)
             self.state = self.STATE_COMPILING
             self.state_blocks = {}
-            self.current_block = script_block = EngineBlock(self)
-            self.blocks.append(self.current_block)
-            for path in self.paths:
-                self.truncate(0)
-                self.seek(0)
-                self.branch_id = 0
-                self.current_path = path
-                ret = func(self)
-                self.write_end(ret)
-                self.current_block.buff = self.getvalue()
-                while self.stack:
-                    self.pop()
-            return script_block
+            self.subroutines = {}
+            self.script_block = EngineBlock(self)
+            self.blocks.append(self.script_block)
+            self._explore(func)
+            if self.deduplicate_blocks:
+                self.deduplicate()
+            if self.optimize_blocks:
+                self.optimize()
+                if self.deduplicate_blocks:
+                    self.deduplicate()
+            return self.script_block
         finally:
             self.state = self.STATE_IDLE
 
-    def _find_branches(self, func):
-        self.paths = [()]
-        self.loops = []
-        self.path_id = 0
-        while self.path_id < len(self.paths):
-            self.current_path = self.paths[self.path_id]
+    def intern(self, block):
+        """Get the canonical block that is structurally equal to `block`
+
+        Parameters
+        ----------
+        block : EngineBlock
+            Complete block to look up
+
+        Returns
+        -------
+        block : EngineBlock
+            First block interned with the same digest
+        """
+        return self.block_table.setdefault(block.digest(), block)
+
+    def deduplicate(self):
+        """Collapse structurally identical blocks into a single block
+
+        Jumps to a duplicate are redirected to its canonical block and the
+        duplicates are dropped from `blocks`.
+        """
+        canonical = dict((id(block), self.intern(block))
+                         for block in self.blocks)
+        blocks = []
+        for block in self.blocks:
+            if canonical[id(block)] is not block:
+                continue
+            for ofs, target in block.jumps.items():
+                block.jumps[ofs] = canonical.get(id(target), target)
+            blocks.append(block)
+        self.blocks = blocks
+        for key, block in self.state_blocks.items():
+            self.state_blocks[key] = canonical.get(id(block), block)
+        self.script_block = canonical[id(self.script_block)]
+
+    def optimize(self, root_block=None):
+        """Run the peephole optimizer over a compiled block graph
+
+        Parameters
+        ----------
+        root_block : EngineBlock, optional
+            Entry block. Defaults to the last compiled script
+
+        Returns
+        -------
+        optimizer : BlockOptimizer
+            Optimizer that was run, with its `stats`
+        """
+        if root_block is None:
+            root_block = self.script_block
+        optimizer = self.optimizer_class(self)
+        optimizer.optimize(root_block)
+        return optimizer
+
+    def layout(self, root_block):
+        """Order the blocks reachable from `root_block` for linking
+
+        Blocks are placed depth first, following jumps in slot order, so a
+        block is usually placed right after the block that first jumps to it.
+
+        Returns
+        -------
+        blocks : list of EngineBlock
+        """
+        order = []
+        placed = set()
+        pending = [root_block]
+        while pending:
+            block = pending.pop()
+            if id(block) in placed:
+                continue
+            placed.add(id(block))
+            order.append(block)
+            for ofs in sorted(block.jumps, reverse=True):
+                target = block.jumps[ofs]
+                if id(target) not in placed:
+                    pending.append(target)
+        return order
+
+    def link(self, root_block=None, base_address=0):
+        """Lay out a compiled block graph into one contiguous image
+
+        Every reachable block is assigned its `offset` and every jump slot
+        is filled in with `write_relocation`.
+
+        Parameters
+        ----------
+        root_block : EngineBlock, optional
+            Entry block. Defaults to the last compiled script
+        base_address : int
+            Address that the image will be loaded at
+
+        Returns
+        -------
+        image : bytearray
+        """
+        if root_block is None:
+            root_block = self.script_block
+        order = self.layout(root_block)
+        image = bytearray()
+        for block in order:
+            block.offset = base_address+len(image)
+            image += block.buff
+        for block in order:
+            position = block.offset-base_address
+            for ofs, target in block.jumps.items():
+                self.write_relocation(image, position+ofs,
+                                      block.offset+ofs,
+                                      block.kinds.get(ofs, block.KIND_JUMP),
+                                      target)
+        return image
+
+    def write_relocation(self, image, position, address, kind, target):
+        """Fill in a jump slot of a linked image
+
+        By default this writes the absolute address of `target`. Override
+        this for targets that use relative or differently sized pointers.
+
+        Parameters
+        ----------
+        image : bytearray
+            Image being linked
+        position : int
+            Index of the slot in `image`
+        address : int
+            Address of the slot once loaded
+        kind : int
+            EngineBlock.KIND_JUMP, KIND_BRANCH or KIND_CALL
+        target : EngineBlock
+            Block the slot points to. Its `offset` is already assigned
+        """
+        image[position:position+self.pointer_size] = self.pack_value(
+            target.offset, self.pointer_size)
+
+    def _explore(self, func):
+        """Run `func` once per path
+
+        Each execution of `func` runs one complete path. When a new decision
+        is reached, the execution continues down the True side and the False
+        side is queued, so no execution is abandoned part way through.
+
+        If `fork_paths` is set and the platform has `os.fork`, `func` is
+        only run once. At each decision the process forks: the child
+        follows the True side to the end of its path and sends what it
+        compiled back, then the parent follows the False side. The code
+        before a decision therefore runs once instead of once per path.
+        Side effects of `func` outside the engine are not sent back, so
+        they are only seen by the process that made them. `executions`
+        stays 1 and `forks` counts the decisions forked at.
+        """
+        self.paths = []
+        self.pending_paths = [()]
+        self.executions = 0
+        self.pruned_branches = 0
+        self.forks = 0
+        self._block_indices = {}
+        snapshot = self.vars._snapshot()
+        while self.pending_paths:
+            self.current_path = self.pending_paths.pop()
             self.branch_id = 0
+            self.loop_id = 0
+            self.loop_stack = []
+            self.vars._restore(snapshot)
+            self.executions += 1
             try:
-                func(self)
-            except NewBranch:
-                self.paths[self.path_id] = self.current_path+(NewBranch,)
-            self.path_id += 1
-        self.paths = [path for path in self.paths
-                      if path[-1:] != (NewBranch, )]
+                self._compile_path(func)
+            except BaseException:
+                if self.path_fork is None:
+                    raise
+                self._exit_fork(sys.exc_info()[1])
+            self.paths.append(self.current_path)
+            if self.path_fork is not None:
+                # End of a forked path. This never returns
+                self._exit_fork()
         self.paths.sort(reverse=True)
 
+    def _compile_path(self, func):
+        self.current_block = self.script_block
+        self.position = 0
+        ret = func(self)
+        self.mark()
+        self.write_end(ret)
+        self.finish_block()
+        while self.stack:
+            self.pop()
+
     def write_branch(self, branch_state, condition):
         ofs = self.tell()
         self.write_value(0, self.pointer_size)
@@ -227,44 +752,452 @@ class Engine(BytesIO):
         self.write_value(0, self.pointer_size)
         return self.tell()-self.pointer_size
 
-    def branch(self, condition):
-        try:
+    def _next_decision(self):
+        if self.branch_id < len(self.current_path):
             value = self.current_path[self.branch_id]
-            self.branch_id += 1
-        except IndexError:
-            self.paths.append(self.current_path+(True, ))
-            self.paths.append(self.current_path+(False, ))
-            raise NewBranch
+        else:
+            # First time a path reaches this decision: follow the True side
+            # now and come back for the False side later
+            if self.fork_paths and hasattr(os, 'fork'):
+                value = self._fork()
+            else:
+                self.pending_paths.append(self.current_path+(False, ))
+                value = True
+            self.current_path += (value, )
+        self.branch_id += 1
+        return value
+
+    def _fork(self):
+        """Fork the process at a new decision
+
+        Returns
+        -------
+        value : bool
+            True in the child. False in the parent, once the child's path
+            has ended and what it compiled has been merged
+        """
+        path_fork = EngineFork(self)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if not pid:
+            os.close(read_fd)
+            path_fork.fd = write_fd
+            self.path_fork = path_fork
+            return True
+        os.close(write_fd)
+        with os.fdopen(read_fd, 'rb') as handle:
+            data = handle.read()
+        os.waitpid(pid, 0)
+        if not data:
+            raise RuntimeError('Forked path exited without a result')
+        self._merge_fork(path_fork, data)
+        self.forks += 1
+        return False
+
+    def _exit_fork(self, error=None):
+        """Send the result of this forked path to the parent and exit
+        """
+        try:
+            if error is None:
+                data = self._dumps(('done', self._fork_result()))
+            else:
+                text = traceback.format_exc()
+                try:
+                    pickle.loads(pickle.dumps(error, pickle.HIGHEST_PROTOCOL))
+                except Exception:
+                    error = None
+                data = self._dumps(('error', (error, text)))
+        except Exception:
+            data = pickle.dumps(('error', (None, traceback.format_exc())),
+                                pickle.HIGHEST_PROTOCOL)
+        try:
+            with os.fdopen(self.path_fork.fd, 'wb') as handle:
+                handle.write(data)
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(0)
+
+    def _fork_result(self):
+        path_fork = self.path_fork
+        blocks = []
+        seen = set()
+        for block in itertools.chain(path_fork.open_blocks, path_fork.touched,
+                                     self.blocks[path_fork.block_count:]):
+            if id(block) in seen:
+                continue
+            seen.add(id(block))
+            blocks.append((block, bytes(block.buff), block.jumps,
+                           block.kinds, block.marks, block.complete))
+        # Keys or return values that cannot be sent are left out. The
+        # parent compiles them again if it reaches them
+        states = [self._dumps_entry((key, self.state_blocks[key]))
+                  for key in path_fork.states]
+        calls = [self._dumps_entry((key, self.subroutines[key]))
+                 for key in path_fork.calls]
+        return {
+            'blocks': blocks,
+            'states': [entry for entry in states if entry is not None],
+            'calls': [entry for entry in calls if entry is not None],
+            'paths': self.paths[path_fork.path_count:],
+            'pruned_branches': self.pruned_branches,
+            'forks': self.forks,
+            'dependencies': self.dependencies,
+        }
+
+    def _merge_fork(self, path_fork, data):
+        kind, result = self._loads(path_fork, data)
+        if kind == 'error':
+            error, text = result
+            if error is None:
+                raise RuntimeError('Error in forked path\n'+text)
+            raise error
+        journal = self.path_fork
+        for block, buff, jumps, kinds, marks, complete in result['blocks']:
+            block.buff = bytearray(buff)
+            block.jumps = jumps
+            block.kinds = kinds
+            block.marks = marks
+            block.complete = complete
+            block._digest = None
+            if journal is not None:
+                journal.touched.append(block)
+        for entry in result['states']:
+            key, block = self._loads(path_fork, entry)
+            self.state_blocks[key] = block
+            if journal is not None:
+                journal.states.append(key)
+        for entry in result['calls']:
+            key, value = self._loads(path_fork, entry)
+            self.subroutines[key] = value
+            if journal is not None:
+                journal.calls.append(key)
+        self.paths.extend(result['paths'])
+        self.pruned_branches = result['pruned_branches']
+        self.forks = result['forks']
+        if self.dependencies is not None:
+            self.dependencies.update(result['dependencies'])
+
+    def _block_index(self, block):
+        indices = self._block_indices
+        for idx in range(len(indices), len(self.blocks)):
+            indices[id(self.blocks[idx])] = idx
+        return indices[id(block)]
+
+    def _dumps(self, value):
+        """Pickle `value` for the parent process
+
+        Blocks are sent as their index in `blocks`, and the objects on the
+        path stack at the fork as their id.
+        """
+        shared = self.path_fork.shared
+
+        def persistent_id(obj):
+            if isinstance(obj, EngineBlock):
+                return ('block', self._block_index(obj))
+            if id(obj) in shared and shared[id(obj)] is obj:
+                return ('shared', id(obj))
+            return None
+        handle = io.BytesIO()
+        pickler = pickle.Pickler(handle, pickle.HIGHEST_PROTOCOL)
+        pickler.persistent_id = persistent_id
+        pickler.dump(value)
+        return handle.getvalue()
+
+    def _dumps_entry(self, value):
+        try:
+            return self._dumps(value)
+        except Exception:
+            return None
+
+    def _loads(self, path_fork, data):
+        def persistent_load(pid):
+            kind, value = pid
+            if kind == 'shared':
+                return path_fork.shared[value]
+            while len(self.blocks) <= value:
+                # Blocks the child created
+                self.blocks.append(EngineBlock(self))
+            return self.blocks[value]
+        unpickler = pickle.Unpickler(io.BytesIO(data))
+        unpickler.persistent_load = persistent_load
+        return unpickler.load()
+
+    def static_condition(self, condition):
+        """Evaluate a branch condition at compile time
+
+        Plain Python values and constant Variables are known statically.
+
+        Raises
+        ------
+        ValueError
+            If the condition can only be decided at run time
+        """
+        if isinstance(condition, (bool, numbers.Number)):
+            return bool(condition)
+        if isinstance(condition, Variable):
+            return bool(condition.get_constant())
+        raise ValueError('{0!r} is not a static condition'.format(condition))
+
+    def branch(self, condition):
+        if self.prune_branches:
+            try:
+                value = self.static_condition(condition)
+            except ValueError:
+                pass
+            else:
+                self.pruned_branches += 1
+                return value
+        if self.subroutine_depth:
+            raise TypeError('Memoized subroutines cannot branch')
+        value = self._next_decision()
         if self.state == self.STATE_COMPILING:
             old_block = self.current_block
+            self.mark()
             true_ofs = self.write_branch(True, condition)
             false_ofs = self.write_branch(False, condition)
+            self.finish_block()
             self.push(value)
             # Write two jumps back to back. True then False
             # Only set the jump for the active branch though
             if value is True:
-                old_block.jumps[true_ofs] = self.current_block
+                old_block.add_jump(true_ofs, self.current_block,
+                                   EngineBlock.KIND_BRANCH)
             if value is False:
-                old_block.jumps[false_ofs] = self.current_block
+                old_block.add_jump(false_ofs, self.current_block,
+                                   EngineBlock.KIND_BRANCH)
         return value
 
     def loop(self, condition):
-        raise NotImplementedError('Loops are not currently handled')
-        return False
+        """Condition of a while loop
+
+        The body of the loop is run once. The first call opens the loop and
+        emits a header block that tests `condition`, with the body as its
+        True target. The next call from the same place closes the loop with
+        a jump back to the header, and the rest of the script goes into the
+        header's False target. The loop is never unrolled and adds no
+        decisions to the path.
+
+        Variables are not constant inside a loop, and variables assigned
+        in the loop stay that way after it until they are assigned again.
+
+        The header needs the condition as the variables are inside the
+        loop. A comparison of a variable is rebuilt from its operands for
+        that, but a condition whose variables were folded into constants,
+        like ``engine.vars.a + 1 > 4`` with a constant `a`, cannot be.
+        Pass such a condition as a function that builds it.
 
-    def call(self, new_func):
+        Parameters
+        ----------
+        condition : Variable, bool or callable
+            Loop condition, or a function with no arguments returning it
+
+        Raises
+        ------
+        ValueError
+            If the condition is a Variable that is still constant inside
+            the loop, so the header would not be a conditional branch
+
+        Example
+        -------
+        >>> while engine.loop(engine.vars.a > 4):
+        ...     engine.vars.a -= 3
+        >>> while engine.loop(lambda: engine.vars.a + 1 > 4):
+        ...     engine.vars.a -= 3
+        """
+        frame = sys._getframe(1)
+        site = (frame, frame.f_lineno)
+        if self.loop_stack and self.loop_stack[-1].site == site:
+            self._close_loop(self.loop_stack.pop())
+            return False
+        build = None
+        if callable(condition) and not isinstance(condition, Variable):
+            build = condition
+        if self.prune_branches:
+            # The first test sees the values from before the loop
+            try:
+                if not self.static_condition(
+                        build() if build else condition):
+                    self.pruned_branches += 1
+                    return False
+            except ValueError:
+                pass
+        consts = {}
+        for name, var in self.vars._cache.items():
+            consts[name] = var.const
+            var.const = False
+        if build is not None:
+            condition = build()
+        elif isinstance(condition, Variable):
+            try:
+                lhs, rhs = condition.operands
+            except AttributeError:
+                pass
+            else:
+                condition = lhs.compare(condition.value[0], rhs)
+        if isinstance(condition, Variable) and condition.is_constant():
+            raise ValueError(
+                'Loop condition {0!r} does not depend on the loop, pass a '
+                'function that builds it'.format(condition))
+        loop = EngineLoop(site, len(self.stack), consts)
         if self.state == self.STATE_COMPILING:
             block = self.current_block
+            self.mark()
+            ofs = self.write_jump()
+            self.finish_block()
+            self.push(('loop', self.loop_id))
+            loop.header = self.current_block
+            block.add_jump(ofs, loop.header, EngineBlock.KIND_JUMP)
+            true_ofs = self.write_branch(True, condition)
+            loop.exit_ofs = self.write_branch(False, condition)
+            self.finish_block()
+            loop.depth = len(self.stack)
+            self.push(True)
+            loop.header.add_jump(true_ofs, self.current_block,
+                                 EngineBlock.KIND_BRANCH)
+        self.loop_id += 1
+        self.loop_stack.append(loop)
+        return True
+
+    def _close_loop(self, loop):
+        for name, const in loop.consts.items():
+            if name not in loop.assigned:
+                self.vars._cache[name].const = const
+        if self.loop_stack:
+            self.loop_stack[-1].assigned.update(loop.assigned)
+        if self.state != self.STATE_COMPILING:
+            return
+        self.mark()
+        ofs = self.write_jump()
+        self.current_block.add_jump(ofs, loop.header, EngineBlock.KIND_JUMP)
+        while len(self.stack) > loop.depth:
+            self.pop()
+        self.push(False)
+        loop.header.add_jump(loop.exit_ofs, self.current_block,
+                             EngineBlock.KIND_BRANCH)
+
+    def call(self, new_func, *args, **kwargs):
+        """Call `new_func` as a subroutine
+
+        Parameters
+        ----------
+        new_func : callable
+            Function called as new_func(engine, *args)
+        *args : list of args
+            Arguments passed to new_func
+        memoize : bool, optional
+            If set, the function is compiled once into a shared subroutine
+            block per set of arguments, and later calls only jump to it.
+            The variables the function assigns are recorded on the first
+            call and assigned again on the later ones. Defaults to
+            `memoize_calls`
+
+        Raises
+        ------
+        TypeError
+            If a memoized function calls `branch`, since a shared block
+            cannot follow the paths of its callers
+        """
+        memoize = kwargs.pop('memoize', self.memoize_calls)
+        if self.dependencies is not None:
+            self.dependencies.add_function(new_func)
+        if memoize and self.state == self.STATE_COMPILING:
+            return self._call_memoized(new_func, args)
+        if self.state == self.STATE_COMPILING:
+            block = self.current_block
+            self.mark()
             ofs = self.write_jump()
             self.push(new_func)
-            block.jumps[ofs] = self.current_block
-        ret = new_func(self)
+            block.add_jump(ofs, self.current_block, EngineBlock.KIND_CALL)
+        ret = new_func(self, *args)
         if self.state == self.STATE_COMPILING:
+            self.mark()
             self.write_end(ret)
             self.pop()
         return ret
 
+    def _call_memoized(self, new_func, args):
+        key = (new_func, self._call_signature(args))
+        block = self.current_block
+        self.mark()
+        ofs = self.write_jump()
+        try:
+            sub_block, ret, writes = self.subroutines[key]
+        except KeyError:
+            sub_block = EngineBlock(self)
+            self.blocks.append(sub_block)
+            self.push(new_func, sub_block)
+            snapshot = self.vars._snapshot()
+            self.subroutine_depth += 1
+            try:
+                ret = new_func(self, *args)
+            finally:
+                self.subroutine_depth -= 1
+            self.mark()
+            self.write_end(ret)
+            self.pop()
+            writes = {}
+            for name, var in self.vars._cache.items():
+                old = snapshot.get(name)
+                if (old is None or old[0] is not var.value or
+                        old[1] != var.const):
+                    writes[name] = (var.value, var.const)
+            self.subroutines[key] = (sub_block, ret, writes)
+            if self.path_fork is not None:
+                self.path_fork.calls.append(key)
+        else:
+            # The body is not run again, so redo its assignments
+            for name, (value, const) in writes.items():
+                setattr(self.vars, name, value)
+                if not self.loop_stack:
+                    self.vars._cache[name].const = const
+        block.add_jump(ofs, sub_block, EngineBlock.KIND_CALL)
+        return ret
+
+    @classmethod
+    def _call_signature(cls, args):
+        """Build a hashable key for the arguments of a memoized call
+
+        Temporaries are recreated on every path, so Variables are keyed by
+        the structure of their values. See `_value_key`
+        """
+        return tuple(cls._value_key(arg) for arg in args)
+
+    @classmethod
+    def _value_key(cls, value, named=()):
+        """Build a hashable key for a value or (oper, lhs, rhs) tuple
+
+        Named variables are keyed by name, plus their value if it is a
+        known constant or the structure of their value if it is not. Other
+        variables are keyed by their value, so equal expressions built on
+        different paths get equal keys. A named variable met again inside
+        its own value, as in a condition assigned to one of its operands,
+        is keyed by name only.
+        """
+        if isinstance(value, Variable):
+            if value.name is not None:
+                try:
+                    return (Variable, value.name, value.get_constant())
+                except ValueError:
+                    pass
+                if value.name in named:
+                    return (Variable, value.name)
+                return (Variable, value.name, value.const, cls._value_key(
+                    value.value, named+(value.name, )))
+            return (Variable, value.const,
+                    cls._value_key(value.value, named))
+        if isinstance(value, tuple):
+            return tuple(cls._value_key(item, named) for item in value)
+        try:
+            hash(value)
+        except TypeError:
+            return (id, id(value))
+        return value
+
     def unknown(self, value, size):
         if self.state == self.STATE_COMPILING:
+            self.mark()
             self.write_value(value, size)
         return '1+1'
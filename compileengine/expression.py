@@ -1,3 +1,4 @@
+import itertools
 
 
 class ExpressionBlockIterator(object):
@@ -27,33 +28,42 @@ class ExpressionBlockIterator(object):
     return
     """
     def __init__(self, block):
-        self.stack = [[block, 0]]
+        self.stack = [self._body(block)]
 
-    def next(self):
+    @staticmethod
+    def _body(block):
+        while isinstance(block, WrapperExpression):
+            block = block.target
+        return itertools.chain(block.header_lines, block.lines,
+                               block.footer_lines)
+
+    @staticmethod
+    def _is_block(expr):
+        try:
+            is_block = expr.is_block
+        except AttributeError:
+            return False
+        return is_block()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
         """Return the next expression from the current block. If there are
         no more lines in the current block, visit the parent item on the
         stack. If there are no more items in the stack, end the loop.
         """
         while self.stack:
-            block, lineno = self.stack[-1]
-            lines = block.header_lines+block.lines+block.footer_lines
-            while True:
-                try:
-                    expr = lines[lineno]
-                except IndexError:
+            for expr in self.stack[-1]:
+                if self._is_block(expr):
+                    self.stack.append(self._body(expr))
                     break
-                lineno += 1
-                self.stack[-1][1] = lineno
-                try:
-                    if expr.is_block():
-                        self.stack.append([expr, 0])
-                        return self.next()
-                except:
-                    pass
                 if expr:
                     return expr
-            self.stack.pop()
+            else:
+                self.stack.pop()
         raise StopIteration()
+    next = __next__
 
 
 class Expression(object):
@@ -80,7 +90,9 @@ class Expression(object):
     >>> print(str(Expression(0, 'my_func2')))
     engine.my_func2()
     """
-    indent = 0
+    # __dict__ is only allocated once something outside the slots is set,
+    # like the attributes a WrapperExpression copies onto its target
+    __slots__ = ('indent', 'name', 'args', 'namespace', '__dict__')
 
     def __init__(self, name, *args, **kwargs):
         self.indent = kwargs.get('indent', 0)
@@ -95,6 +107,13 @@ class Expression(object):
             func=self.name,
             args=', '.join(str(arg) for arg in self.args))
 
+    def __getattr__(self, name):
+        # Only reached for unset slots. Derived classes that do not call
+        # Expression.__init__ are not indented
+        if name == 'indent':
+            return 0
+        raise AttributeError(name)
+
     def is_return(self):
         return False
 
@@ -104,6 +123,7 @@ class Expression(object):
 
 class WrapperExpression(Expression):
     def __init__(self, expression, **target_attrs):
+        self.indent = 0
         self.target = expression
         self.target_attrs = target_attrs
 
@@ -141,7 +161,10 @@ class UnknownExpression(Expression):
         Number of bytes this should be padded to.
 
     """
+    __slots__ = ('value', 'width')
+
     def __init__(self, value, width=2):
+        self.indent = 0
         self.value = value
         self.width = width
 
@@ -155,6 +178,11 @@ class UnknownExpression(Expression):
 class NoopExpression(Expression):
     """An empty expression.
     """
+    __slots__ = ()
+
+    def __init__(self):
+        self.indent = 0
+
     def __str__(self):
         return ''
 
@@ -168,7 +196,10 @@ class ReturnExpression(Expression):
 
     This is the last expression of a block.
     """
+    __slots__ = ()
+
     def __init__(self, *args):
+        self.indent = 0
         self.args = args
 
     def __str__(self):
@@ -198,7 +229,10 @@ class AssignmentExpression(Expression):
     >>> print(AssignmentExpression(0, 'engine.vars.b', 42))
     engine.vars.b = 42
     """
+    __slots__ = ('dest', 'expression')
+
     def __init__(self, dest, expression):
+        self.indent = 0
         self.dest = dest
         self.expression = expression
 
@@ -223,7 +257,10 @@ class StatementExpression(Expression):
     *args : list
         Target list of arguments
     """
+    __slots__ = ('operator', )
+
     def __init__(self, operator, *args):
+        self.indent = 0
         self.operator = operator
         self.args = args
 
@@ -241,7 +278,10 @@ class ContextExpression(Expression):
     dest : string
         Destination right value. Optional.
     """
+    __slots__ = ('expression', 'dest')
+
     def __init__(self, expression, dest=None):
+        self.indent = 0
         self.expression = expression
         self.dest = dest
 
@@ -261,8 +301,9 @@ class ConditionalExpression(Expression):
     Attributes
     ----------
     conditional : Statement or Expression
-    loop_type : (TYPE_IF, TYPE_WHILE)
-        Specifies type of condition. Defaults to TYPE_IF (no loop)
+    loop_type : (TYPE_IF, TYPE_WHILE, TYPE_ELSE)
+        Specifies type of condition. Defaults to TYPE_IF (no loop).
+        TYPE_ELSE ignores `conditional`
 
     Notes
     -----
@@ -270,12 +311,18 @@ class ConditionalExpression(Expression):
     """
     TYPE_IF = 0
     TYPE_WHILE = 1
+    TYPE_ELSE = 2
+
+    __slots__ = ('conditional', 'loop_type')
 
     def __init__(self, conditional=None, loop_type=0):
+        self.indent = 0
         self.conditional = conditional
         self.loop_type = loop_type
 
     def __str__(self):
+        if self.loop_type == self.TYPE_ELSE:
+            return '{space}else:'.format(space='    '*self.indent)
         if self.loop_type == self.TYPE_IF:
             prefix = 'if'
         elif self.loop_type == self.TYPE_WHILE:
@@ -286,6 +333,54 @@ class ConditionalExpression(Expression):
             conditional=str(self.conditional))
 
 
+class JumpExpression(Expression):
+    """Unstructured jump, as read from a script before its control flow
+    is recovered
+
+    Attributes
+    ----------
+    target : hashable
+        Label jumped to. See `LabelExpression`
+    unless : Statement or Expression or None
+        If given, the jump is only taken when this is false
+
+    See Also
+    --------
+    compileengine.passes.ConditionalBlockPass
+    """
+    __slots__ = ('target', 'unless')
+
+    def __init__(self, target, unless=None):
+        self.indent = 0
+        self.target = target
+        self.unless = unless
+
+    def __str__(self):
+        if self.unless is None:
+            condition = ''
+        else:
+            condition = ', unless={0}'.format(self.unless)
+        return '{space}engine.jump({target!r}{condition})'.format(
+            space='    '*self.indent,
+            target=self.target,
+            condition=condition)
+
+
+class LabelExpression(Expression):
+    """Destination of a JumpExpression
+    """
+    __slots__ = ('target', )
+
+    def __init__(self, target):
+        self.indent = 0
+        self.target = target
+
+    def __str__(self):
+        return '{space}engine.label({target!r})'.format(
+            space='    '*self.indent,
+            target=self.target)
+
+
 class ExpressionBlock(Expression):
     """Block of expressions. This contains a list of expressions
 
@@ -311,19 +406,68 @@ class ExpressionBlock(Expression):
     def __iter__(self):
         return ExpressionBlockIterator(self)
 
-    def __str__(self):
-        out = []
-        for indent, lines in ((self.header_indent, self.header_lines),
-                              (self.indent, self.lines),
-                              (self.footer_indent, self.footer_lines)):
-            for expr in lines:
+    def sections(self):
+        """Get the (indent, lines) pairs of this block in output order
+        """
+        return ((self.header_indent, self.header_lines),
+                (self.indent, self.lines),
+                (self.footer_indent, self.footer_lines))
+
+    def iter_lines(self):
+        """Yield each line of the source of this block
+
+        Nested blocks are walked with an explicit stack, and every line is
+        built once with its full indentation, so this is linear in the size
+        of the output.
+        """
+        # Frames are [(prefix, expr) iterator, prefix, lines yielded]
+        frames = [[self._prefixed(self, ''), '', False]]
+        while frames:
+            frame = frames[-1]
+            for prefix, expr in frame[0]:
+                while (isinstance(expr, WrapperExpression) and
+                       isinstance(expr.target, ExpressionBlock)):
+                    expr = expr.target
+                if (isinstance(expr, ExpressionBlock) and
+                        type(expr).__str__ is ExpressionBlock.__str__):
+                    frames.append([self._prefixed(expr, prefix), prefix,
+                                   False])
+                    break
                 for line in str(expr).split('\n'):
-                    out.append(
-                        '{space}{line}'.format(
-                            space='    '*indent,
-                            line=line))
-        return '\n'.join(out)
-        # return '\n'.join(str(line) for line in self)
+                    yield prefix+line
+                frame[2] = True
+            else:
+                frames.pop()
+                if not frames:
+                    break
+                if frame[2]:
+                    frames[-1][2] = True
+                else:
+                    # An empty nested block still takes up a line
+                    yield frame[1]
+                    frames[-1][2] = True
+
+    @staticmethod
+    def _prefixed(block, prefix):
+        for indent, lines in block.sections():
+            space = prefix+'    '*indent
+            for expr in lines:
+                yield space, expr
+
+    def render(self, fp):
+        """Write the source of this block to a file-like object
+
+        The output is the same as str(block), without building it in memory.
+        """
+        first = True
+        for line in self.iter_lines():
+            if not first:
+                fp.write('\n')
+            fp.write(line)
+            first = False
+
+    def __str__(self):
+        return '\n'.join(self.iter_lines())
 
     def unknown(self, value, width=2):
         return UnknownExpression(value, width)
@@ -360,6 +504,12 @@ class ExpressionBlock(Expression):
         return ConditionalExpression(statement,
                                      ConditionalExpression.TYPE_WHILE)
 
+    def jump(self, target, unless=None):
+        return JumpExpression(target, unless)
+
+    def label(self, target):
+        return LabelExpression(target)
+
     def statement(self, operator, *args):
         return StatementExpression(operator, *args)
 
@@ -0,0 +1,331 @@
+
+import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from compileengine.expression import (
+    AssignmentExpression, ConditionalExpression, ContextExpression,
+    Expression, ExpressionBlock, NoopExpression, ReturnExpression,
+    StatementExpression, UnknownExpression, WrapperExpression)
+
+KIND_CALL = 0
+KIND_UNKNOWN = 1
+KIND_NOOP = 2
+KIND_RETURN = 3
+KIND_ASSIGN = 4
+KIND_STATEMENT = 5
+KIND_CONTEXT = 6
+KIND_CONDITION = 7
+KIND_BLOCK = 8
+KIND_SECTION = 9
+KIND_OBJECT = 10
+
+# Exact classes only. Derived classes may change how they are printed
+EXPRESSION_KINDS = {
+    Expression: KIND_CALL,
+    UnknownExpression: KIND_UNKNOWN,
+    NoopExpression: KIND_NOOP,
+    ReturnExpression: KIND_RETURN,
+    AssignmentExpression: KIND_ASSIGN,
+    StatementExpression: KIND_STATEMENT,
+    ContextExpression: KIND_CONTEXT,
+    ConditionalExpression: KIND_CONDITION,
+}
+
+# Constants of these types are interned by value, anything else by identity
+VALUE_TYPES = (bool, int, float, str, bytes, type(None))
+
+COLUMNS = (('kind', 'B'), ('indent', 'h'), ('name', 'i'),
+           ('namespace', 'i'), ('first', 'i'), ('count', 'i'), ('aux', 'q'))
+
+
+class _Section(object):
+    """Header, body or footer of a block while it is being added
+    """
+    __slots__ = ('indent', 'lines')
+
+    def __init__(self, indent, lines):
+        self.indent = indent
+        self.lines = lines
+
+
+class ExpressionTable(object):
+    """Array-backed storage for many expression trees
+
+    Every expression is one row across parallel columns. Operands are
+    stored in the shared `operands` column: a non-negative operand is the
+    index of another row, and a negative operand `~idx` is `constants[idx]`.
+    Rows are added children first, so the rows of a tree are contiguous and
+    end with its root.
+
+    Columns
+    -------
+    kind : KIND_ constant
+    indent : indentation the expression was printed with
+    name : function name or statement operator, as an index into `names`
+    namespace : namespace, as an index into `names`
+    first, count : range of the row's operands in `operands`
+    aux : width of an unknown, loop type of a condition
+
+    Blocks have three KIND_SECTION operands for their header, body and
+    footer, and each section has its lines as operands. Expressions of
+    derived classes are kept whole as KIND_OBJECT rows.
+
+    Attributes
+    ----------
+    names : list of str
+        Interned names
+    constants : list
+        Interned operand values
+    roots : dict
+        Map of key to the root row of each tree added with a key
+
+    Example
+    -------
+    >>> table = ExpressionTable()
+    >>> root = table.add(decompiler, 0x1000)
+    >>> calls = table.find(KIND_CALL, 'my_func')
+    >>> print(table.source(root))
+    """
+    def __init__(self):
+        for name, typecode in COLUMNS:
+            setattr(self, name, array.array(typecode))
+        self.operands = array.array('i')
+        self.names = []
+        self.constants = []
+        self.roots = {}
+        self._name_index = {}
+        self._constant_index = {}
+
+    def __len__(self):
+        return len(self.kind)
+
+    def intern_name(self, name):
+        try:
+            return self._name_index[name]
+        except KeyError:
+            idx = self._name_index[name] = len(self.names)
+            self.names.append(name)
+            return idx
+
+    def intern_constant(self, value):
+        if isinstance(value, VALUE_TYPES):
+            key = (type(value), value)
+        else:
+            key = id(value)
+        try:
+            return self._constant_index[key]
+        except KeyError:
+            idx = self._constant_index[key] = len(self.constants)
+            self.constants.append(value)
+            return idx
+
+    @staticmethod
+    def classify(expr):
+        """Get the row kind of `expr`
+        """
+        try:
+            return EXPRESSION_KINDS[type(expr)]
+        except KeyError:
+            pass
+        if type(expr) is _Section:
+            return KIND_SECTION
+        if (isinstance(expr, ExpressionBlock) and
+                type(expr).__str__ is ExpressionBlock.__str__):
+            return KIND_BLOCK
+        return KIND_OBJECT
+
+    @staticmethod
+    def _operands(expr, kind):
+        if kind in (KIND_CALL, KIND_RETURN, KIND_STATEMENT):
+            return expr.args
+        if kind == KIND_UNKNOWN:
+            return (expr.value, )
+        if kind in (KIND_ASSIGN, KIND_CONTEXT):
+            return (expr.dest, expr.expression)
+        if kind == KIND_CONDITION:
+            return (expr.conditional, )
+        if kind == KIND_BLOCK:
+            return [_Section(indent, lines)
+                    for indent, lines in expr.sections()]
+        if kind == KIND_SECTION:
+            return expr.lines
+        return ()
+
+    def add(self, expr, key=None):
+        """Add the tree rooted at `expr`
+
+        Wrappers are replaced by their targets, so the tree is stored the
+        way it is printed.
+
+        Returns
+        -------
+        idx : int
+            Root row
+        """
+        # Frames are [expression, kind, operand iterator, encoded operands]
+        stack = []
+        pending = expr
+        while True:
+            if pending is not None:
+                while (type(pending) is WrapperExpression and
+                       isinstance(pending.target, Expression)):
+                    pending = pending.target
+                kind = self.classify(pending)
+                stack.append([pending, kind,
+                              iter(self._operands(pending, kind)), []])
+                pending = None
+            frame = stack[-1]
+            for operand in frame[2]:
+                if isinstance(operand, (Expression, _Section)):
+                    pending = operand
+                    break
+                frame[3].append(~self.intern_constant(operand))
+            else:
+                stack.pop()
+                idx = self._append(*frame)
+                if not stack:
+                    break
+                stack[-1][3].append(idx)
+        if key is not None:
+            self.roots[key] = idx
+        return idx
+
+    def _append(self, expr, kind, operands, encoded):
+        name = namespace = -1
+        aux = 0
+        if kind == KIND_OBJECT:
+            encoded = [~self.intern_constant(expr)]
+        elif kind == KIND_CALL:
+            name = self.intern_name(expr.name)
+            namespace = self.intern_name(expr.namespace)
+        elif kind == KIND_BLOCK:
+            namespace = self.intern_name(expr.namespace)
+        elif kind == KIND_STATEMENT:
+            name = self.intern_name(expr.operator)
+        elif kind == KIND_UNKNOWN:
+            aux = expr.width
+        elif kind == KIND_CONDITION:
+            aux = expr.loop_type
+        idx = len(self.kind)
+        self.kind.append(kind)
+        self.indent.append(expr.indent)
+        self.name.append(name)
+        self.namespace.append(namespace)
+        self.first.append(len(self.operands))
+        self.count.append(len(encoded))
+        self.aux.append(aux)
+        self.operands.extend(encoded)
+        return idx
+
+    def operands_of(self, idx):
+        first = self.first[idx]
+        return self.operands[first:first+self.count[idx]]
+
+    def column(self, name):
+        """Get a column for scanning
+
+        Returns
+        -------
+        column : numpy.ndarray or array.array
+            A copy as a numpy array if numpy is installed, so that the
+            table can keep growing. Otherwise the column itself
+        """
+        column = getattr(self, name)
+        if numpy is None:
+            return column
+        return numpy.frombuffer(column, dtype=column.typecode).copy()
+
+    def find(self, kind, name=None):
+        """Find the rows of `kind`, optionally with the name `name`
+
+        Returns
+        -------
+        rows : list of int
+        """
+        if name is not None:
+            try:
+                name = self._name_index[name]
+            except KeyError:
+                return []
+        if numpy is not None:
+            mask = self.column('kind') == kind
+            if name is not None:
+                mask &= self.column('name') == name
+            return numpy.flatnonzero(mask).tolist()
+        kinds = self.kind
+        if name is None:
+            return [idx for idx in range(len(kinds)) if kinds[idx] == kind]
+        names = self.name
+        return [idx for idx in range(len(kinds))
+                if kinds[idx] == kind and names[idx] == name]
+
+    def subtree_start(self, idx):
+        """Get the first row of the tree rooted at `idx`
+        """
+        while True:
+            for operand in self.operands_of(idx):
+                if operand >= 0:
+                    idx = operand
+                    break
+            else:
+                return idx
+
+    def materialize(self, idx):
+        """Build the Expression objects of the tree rooted at `idx`
+
+        Only the rows of that tree are visited.
+
+        Returns
+        -------
+        expr : Expression
+        """
+        built = {}
+        for row in range(self.subtree_start(idx), idx+1):
+            args = [built.pop(operand) if operand >= 0
+                    else self.constants[~operand]
+                    for operand in self.operands_of(row)]
+            built[row] = self._build(row, args)
+        return built[idx]
+
+    def _build(self, row, args):
+        kind = self.kind[row]
+        if kind == KIND_OBJECT:
+            return args[0]
+        if kind == KIND_SECTION:
+            return _Section(self.indent[row], args)
+        if kind == KIND_BLOCK:
+            expr = ExpressionBlock(self.indent[row])
+            expr.namespace = self.names[self.namespace[row]]
+            ((expr.header_indent, expr.header_lines),
+             (expr.indent, expr.lines),
+             (expr.footer_indent, expr.footer_lines)) = [
+                (section.indent, section.lines) for section in args]
+            return expr
+        if kind == KIND_CALL:
+            expr = Expression(self.names[self.name[row]], *args,
+                              namespace=self.names[self.namespace[row]])
+        elif kind == KIND_UNKNOWN:
+            expr = UnknownExpression(args[0], self.aux[row])
+        elif kind == KIND_NOOP:
+            expr = NoopExpression()
+        elif kind == KIND_RETURN:
+            expr = ReturnExpression(*args)
+        elif kind == KIND_ASSIGN:
+            expr = AssignmentExpression(*args)
+        elif kind == KIND_STATEMENT:
+            expr = StatementExpression(self.names[self.name[row]], *args)
+        elif kind == KIND_CONTEXT:
+            expr = ContextExpression(args[1], args[0])
+        elif kind == KIND_CONDITION:
+            expr = ConditionalExpression(args[0], self.aux[row])
+        expr.indent = self.indent[row]
+        return expr
+
+    def source(self, idx):
+        """Get the source of the tree rooted at `idx`
+        """
+        return str(self.materialize(idx))
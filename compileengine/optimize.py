@@ -0,0 +1,375 @@
+
+import collections
+import hashlib
+import struct
+
+
+class PeepholeRule(object):
+    """Opcode level rewrite of a single block
+
+    Derived classes implement `apply`. Rules are plugged into an optimizer
+    through `BlockOptimizer.rules`.
+    """
+    @property
+    def name(self):
+        return self.__class__.__name__
+
+    def apply(self, optimizer, block):
+        """Rewrite `block` in place
+
+        Use `EngineBlock.splice` to change bytes, and `optimizer.retarget`
+        to change where a slot points, so that predecessor counts stay
+        correct.
+
+        Returns
+        -------
+        rewritten : bool
+        """
+        return False
+
+
+class BlockOptimizer(object):
+    """Peephole optimizer over a compiled block graph
+
+    Rewrites
+    --------
+    threading
+        A slot pointing to a block that only jumps is pointed at that
+        jump's destination instead
+    branch collapsing
+        A branch whose targets are the same block becomes a jump
+    merging
+        A block ending in a jump to a block that nothing else reaches gets
+        that block's bytes in place of the jump. Jumps to empty blocks are
+        always replaced by the (empty) block
+    empty calls
+        Calls to empty blocks are removed
+    tail merging
+        Identical code at the end of several blocks is moved into one
+        shared block that they jump to. See `merge_tails`
+    unreachable blocks
+        Blocks no longer reachable from the entry are dropped from
+        `Engine.blocks`
+
+    Jump, branch and call instructions are recognized by comparing bytes
+    to what `Engine.write_jump` and `Engine.write_branch` emit into a
+    scratch block, so only instructions that encode nothing but their slots
+    are rewritten. Instructions that depend on the branch condition are
+    left to `rules`.
+
+    Attributes
+    ----------
+    engine : Engine
+    rules : list
+        PeepholeRule classes or instances, tried after the built in rewrites
+    tail_merging : bool
+        Whether to run `merge_tails`
+    stats : Counter
+        Number of each rewrite made
+    """
+    rules = ()
+    tail_merging = True
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.rules = [rule() if isinstance(rule, type) else rule
+                      for rule in self.rules]
+        self.stats = collections.Counter()
+        self.predecessors = collections.Counter()
+        block = engine.current_block
+        self.kind_jump = block.KIND_JUMP
+        self.kind_branch = block.KIND_BRANCH
+        self.kind_call = block.KIND_CALL
+        self.jump_template = self.assemble(
+            lambda: [engine.write_jump()])
+        self.branch_template = self.assemble(
+            lambda: [engine.write_branch(True, None),
+                     engine.write_branch(False, None)])
+
+    def assemble(self, writer):
+        """Get the bytes `writer` emits into an empty block
+
+        Returns
+        -------
+        template : (bytes, list of int) or None
+            Bytes and the slot offsets returned by `writer`, or None if
+            `writer` failed
+        """
+        engine = self.engine
+        saved = engine.current_block, engine.position
+        engine.current_block = type(saved[0])(engine)
+        engine.position = 0
+        try:
+            slots = writer()
+            data = bytes(engine.current_block.buff)
+        except Exception:
+            return None
+        finally:
+            engine.current_block, engine.position = saved
+        if not data:
+            return None
+        return data, slots
+
+    def tail(self, block, template, kind):
+        """Get where `block` ends with the instruction of `template`
+
+        Returns
+        -------
+        start : int or None
+        """
+        if template is None:
+            return None
+        data, slots = template
+        start = len(block.buff)-len(data)
+        if start < 0 or block.buff[start:] != data:
+            return None
+        for ofs in slots:
+            if (start+ofs not in block.jumps or
+                    block.kinds.get(start+ofs) != kind):
+                return None
+        return start
+
+    def jump_target(self, block):
+        """Get the destination of a block that is only a jump, or None
+        """
+        if len(block.jumps) != 1:
+            return None
+        start = self.tail(block, self.jump_template, self.kind_jump)
+        if start != 0:
+            return None
+        return block.jumps[self.jump_template[1][0]]
+
+    def retarget(self, block, ofs, target):
+        self.predecessors[id(block.jumps[ofs])] -= 1
+        self.predecessors[id(target)] += 1
+        block.jumps[ofs] = target
+        block._digest = None
+
+    def thread_jumps(self, block):
+        rewritten = False
+        for ofs, target in list(block.jumps.items()):
+            seen = set([id(target)])
+            final = target
+            while True:
+                following = self.jump_target(final)
+                if following is None or id(following) in seen:
+                    break
+                seen.add(id(following))
+                final = following
+            if final is not target:
+                self.retarget(block, ofs, final)
+                self.stats['threaded'] += 1
+                rewritten = True
+        return rewritten
+
+    def collapse_branch(self, block):
+        start = self.tail(block, self.branch_template, self.kind_branch)
+        if start is None or self.jump_template is None:
+            return False
+        targets = [block.jumps[start+ofs]
+                   for ofs in self.branch_template[1]]
+        if any(target is not targets[0] for target in targets):
+            return False
+        self.predecessors[id(targets[0])] -= len(targets)-1
+        data, slots = self.jump_template
+        block.splice(start, len(block.buff), data,
+                     [(slots[0], targets[0], self.kind_jump)])
+        self.stats['collapsed'] += 1
+        return True
+
+    def merge_tail(self, block):
+        start = self.tail(block, self.jump_template, self.kind_jump)
+        if start is None:
+            return False
+        target = block.jumps[start+self.jump_template[1][0]]
+        if target is block:
+            return False
+        if target.buff and self.predecessors[id(target)] != 1:
+            return False
+        self.predecessors[id(target)] -= 1
+        block.splice(start, len(block.buff), target.buff,
+                     [(ofs, jump, target.kinds.get(ofs, self.kind_jump))
+                      for ofs, jump in target.jumps.items()], target.marks)
+        if target.buff:
+            # The target's slots now belong to this block instead
+            self.stats['merged'] += 1
+        else:
+            self.stats['empty'] += 1
+        return True
+
+    def remove_empty_calls(self, block):
+        if self.jump_template is None:
+            return False
+        data, slots = self.jump_template
+        for ofs, target in sorted(block.jumps.items()):
+            if (target.buff or target.jumps or
+                    block.kinds.get(ofs) != self.kind_call):
+                continue
+            start = ofs-slots[0]
+            if start < 0 or block.buff[start:start+len(data)] != data:
+                continue
+            self.predecessors[id(target)] -= 1
+            block.splice(start, start+len(data))
+            self.stats['empty_calls'] += 1
+            return True
+        return False
+
+    def suffixes(self, block):
+        """Hash every suffix of `block` that starts at a mark
+
+        Each suffix covers its bytes with the jump slots masked, and the
+        offset, kind and target of each slot in it.
+
+        Returns
+        -------
+        suffixes : list of (bytes, int)
+            (digest, start) of each suffix, shortest first. The last one
+            is the whole block
+        """
+        size = len(block.buff)
+        bounds = sorted(set(mark for mark in block.marks if 0 < mark < size))
+        masked = block.masked()
+        slots = sorted(block.jumps.items())
+        suffixes = []
+        digest = b''
+        stop = size
+        for start in reversed([0]+bounds):
+            hasher = hashlib.sha1(digest)
+            hasher.update(masked[start:stop])
+            while slots and slots[-1][0] >= start:
+                ofs, target = slots.pop()
+                hasher.update(struct.pack('<IBQ', size-ofs,
+                                          block.kinds.get(ofs, 0),
+                                          id(target)))
+            digest = hasher.digest()
+            suffixes.append((digest, start))
+            stop = start
+        return suffixes
+
+    def merge_tails(self, root_block):
+        """Share identical block suffixes
+
+        Suffixes starting at marks are grouped by hash. Going from the
+        longest down, each group is moved into one block, either a block
+        that consists of exactly that suffix or a new one, and the others
+        jump there instead. This repeats until nothing is shared, so the
+        code after a join point is emitted once instead of once per path.
+
+        Returns
+        -------
+        changed : bool
+        """
+        if self.jump_template is None:
+            return False
+        jump_data, jump_slots = self.jump_template
+        changed = False
+        while True:
+            groups = collections.OrderedDict()
+            for block in self.engine.layout(root_block):
+                for digest, start in self.suffixes(block):
+                    groups.setdefault(digest, []).append((block, start))
+            candidates = sorted(
+                (start-len(entries[0][0].buff), order, digest)
+                for order, (digest, entries) in enumerate(groups.items())
+                for start in [entries[0][1]] if len(entries) > 1)
+            touched = set()
+            for length, order, digest in candidates:
+                length = -length
+                entries = [(block, start) for block, start in groups[digest]
+                           if id(block) not in touched]
+                shared = None
+                for block, start in entries:
+                    if not start and (shared is None or block is root_block):
+                        # Never turn the entry into a jump
+                        shared = block
+                if length <= len(jump_data):
+                    # Only whole duplicate blocks are worth replacing, as
+                    # they are threaded past and dropped afterwards
+                    entries = [(block, start) for block, start in entries
+                               if not start]
+                if len(entries) < 2:
+                    continue
+                if shared is None:
+                    if ((len(entries)-1)*length <=
+                            len(entries)*len(jump_data)):
+                        continue
+                    block, start = entries[0]
+                    shared = type(block)(self.engine)
+                    shared.splice(
+                        0, 0, block.buff[start:],
+                        [(ofs-start, target,
+                          block.kinds.get(ofs, self.kind_jump))
+                         for ofs, target in block.jumps.items()
+                         if ofs >= start],
+                        [mark-start for mark in block.marks
+                         if mark >= start])
+                    shared.complete = True
+                    self.engine.blocks.append(shared)
+                    self.stats['shared'] += 1
+                touched.add(id(shared))
+                for block, start in entries:
+                    if block is shared:
+                        continue
+                    block.splice(start, len(block.buff), jump_data,
+                                 [(jump_slots[0], shared, self.kind_jump)])
+                    touched.add(id(block))
+                    self.stats['tails'] += 1
+            if not touched:
+                return changed
+            changed = True
+
+    def count_predecessors(self, blocks, root_block):
+        self.predecessors.clear()
+        # The entry is reached from outside the graph
+        self.predecessors[id(root_block)] += 1
+        for block in blocks:
+            for target in block.jumps.values():
+                self.predecessors[id(target)] += 1
+
+    def optimize(self, root_block):
+        """Optimize the graph reachable from `root_block` in place
+
+        Returns
+        -------
+        blocks : list of EngineBlock
+            Blocks that are still reachable, in `Engine.layout` order
+        """
+        engine = self.engine
+        before = engine.layout(root_block)
+        passes = [self.thread_jumps, self.collapse_branch, self.merge_tail,
+                  self.remove_empty_calls]
+        passes.extend(lambda block, rule=rule: rule.apply(self, block)
+                      for rule in self.rules)
+        blocks = before
+        changed = True
+        while changed:
+            changed = False
+            self.count_predecessors(blocks, root_block)
+            for block in blocks:
+                if not self.predecessors[id(block)]:
+                    # Merged into its only predecessor earlier in this sweep
+                    continue
+                while any(rewrite(block) for rewrite in passes):
+                    changed = True
+            if not changed and self.tail_merging:
+                # Blocks emptied by tail merging are threaded past next
+                changed = self.merge_tails(root_block)
+            blocks = engine.layout(root_block)
+        reachable = set(id(block) for block in blocks)
+        removed = set(id(block) for block in before
+                      if id(block) not in reachable)
+        self.stats['unreachable'] += len(removed)
+        engine.blocks = [block for block in engine.blocks
+                         if id(block) not in removed]
+        for key, block in list(engine.state_blocks.items()):
+            if id(block) in removed:
+                del engine.state_blocks[key]
+        # Digests of anything reaching a rewritten block are stale
+        interned = list(engine.block_table.values())
+        engine.block_table = {}
+        for block in interned+engine.blocks:
+            block._digest = None
+        for block in interned+engine.blocks:
+            if id(block) not in removed:
+                engine.intern(block)
+        return blocks
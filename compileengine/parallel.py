@@ -0,0 +1,164 @@
+
+import collections
+import inspect
+import mmap
+
+try:
+    from concurrent.futures import ProcessPoolExecutor
+except ImportError:
+    ProcessPoolExecutor = None
+
+from compileengine.decompiler import BufferDecompiler
+from compileengine.engine import Engine
+
+# Per-process state set up by the pool initializers
+_worker = {}
+
+
+def _init_decompile_worker(path, decompiler_class, render):
+    with open(path, 'rb') as handle:
+        _worker['buffer'] = mmap.mmap(handle.fileno(), 0,
+                                      access=mmap.ACCESS_READ)
+    _worker['decompiler_class'] = decompiler_class
+    _worker['render'] = render
+
+
+def _parse_range(buff, decompiler_class, render, bounds):
+    start, stop = bounds
+    decompiler = decompiler_class(buff, start)
+    decompiler.stop = stop
+    decompiler.parse()
+    return render(decompiler)
+
+
+def _decompile_range(bounds):
+    return _parse_range(_worker['buffer'], _worker['decompiler_class'],
+                        _worker['render'], bounds)
+
+
+def decompile_batch(path, ranges, decompiler_class=BufferDecompiler,
+                    render=str, workers=None, chunksize=16):
+    """Decompile many independent scripts from one file in parallel
+
+    Each worker process maps the file once and parses its share of
+    `ranges` with `decompiler_class`. Results are yielded in the same order
+    as `ranges` while later ones are still being parsed.
+
+    Parameters
+    ----------
+    path : str
+        File to decompile from
+    ranges : iterable of (int, int or None)
+        (start, stop) of each script. See `Decompiler.stop`
+    decompiler_class : type
+        BufferDecompiler subclass. It must be importable by the workers
+    render : callable
+        Converts a parsed decompiler into the value that is sent back.
+        Defaults to the script source. It must be importable by the workers
+    workers : int, optional
+        Number of processes. Defaults to the number of CPUs. With 1, or
+        without concurrent.futures, everything runs in this process
+    chunksize : int
+        Number of ranges sent to a worker at a time
+
+    Yields
+    ------
+    result
+        `render(decompiler)` for each range
+    """
+    initargs = (path, decompiler_class, render)
+    if workers == 1 or ProcessPoolExecutor is None:
+        # Keep the state local, since several of these generators may be
+        # consumed at once
+        with open(path, 'rb') as handle:
+            buff = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for bounds in ranges:
+                yield _parse_range(buff, decompiler_class, render, bounds)
+        finally:
+            buff.close()
+        return
+    with ProcessPoolExecutor(workers, initializer=_init_decompile_worker,
+                             initargs=initargs) as executor:
+        for result in executor.map(_decompile_range, ranges,
+                                   chunksize=chunksize):
+            yield result
+
+
+def _init_compile_worker(engine_class, base_address):
+    _worker['engine'] = engine_class()
+    _worker['base_address'] = base_address
+
+
+def _compile_script(item):
+    name, func = item
+    engine = _worker['engine']
+    engine.reset()
+    root = engine.compile(func)
+    return name, bytes(engine.link(root, _worker['base_address']))
+
+
+def script_functions(scripts):
+    """Get (name, function) pairs sorted by name
+
+    Parameters
+    ----------
+    scripts : module, dict or list
+        A module contributes every public function defined in it. A dict
+        maps names to functions. Functions in a list are named by
+        `__name__`
+    """
+    if inspect.ismodule(scripts):
+        scripts = dict(
+            (name, value) for name, value in vars(scripts).items()
+            if inspect.isfunction(value) and not name.startswith('_')
+            and value.__module__ == scripts.__name__)
+    elif not isinstance(scripts, dict):
+        funcs = list(scripts)
+        scripts = dict((func.__name__, func) for func in funcs)
+        if len(scripts) != len(funcs):
+            raise ValueError('Script function names are not unique')
+    return sorted(scripts.items())
+
+
+def compile_batch(scripts, engine_class=Engine, base_address=0,
+                  workers=None, chunksize=1):
+    """Compile and link many scripts in parallel
+
+    Each worker process keeps one engine and resets it between scripts.
+    Scripts are compiled independently, so the output does not depend on
+    the number of workers or on scheduling.
+
+    Parameters
+    ----------
+    scripts : module, dict or list
+        Script functions. See `script_functions`. Functions must be
+        importable by the workers
+    engine_class : type
+        Engine class used to compile every script
+    base_address : int
+        Address each image is linked at. See `Engine.link`
+    workers : int, optional
+        Number of processes. Defaults to the number of CPUs. With 1, or
+        without concurrent.futures, everything runs in this process
+    chunksize : int
+        Number of scripts sent to a worker at a time
+
+    Returns
+    -------
+    images : OrderedDict
+        Map of script name to its linked image, sorted by name
+    """
+    items = script_functions(scripts)
+    initargs = (engine_class, base_address)
+    if workers == 1 or ProcessPoolExecutor is None:
+        _init_compile_worker(*initargs)
+        try:
+            return collections.OrderedDict(
+                _compile_script(item) for item in items)
+        finally:
+            _worker.clear()
+    with ProcessPoolExecutor(workers, initializer=_init_compile_worker,
+                             initargs=initargs) as executor:
+        return collections.OrderedDict(
+            executor.map(_compile_script, items, chunksize=chunksize))
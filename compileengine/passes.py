@@ -0,0 +1,331 @@
+
+import collections
+import timeit
+
+from compileengine.expression import (
+    AssignmentExpression, ConditionalExpression, ExpressionBlock,
+    JumpExpression, LabelExpression, NoopExpression)
+from compileengine.variable import Variable
+
+
+class PassStats(object):
+    """Counters of one pass
+
+    Attributes
+    ----------
+    visits : int
+        Number of lines the pass looked at
+    rewrites : int
+        Number of those that it changed
+    elapsed : float
+        Seconds spent in the pass
+    """
+    __slots__ = ('visits', 'rewrites', 'elapsed')
+
+    def __init__(self):
+        self.visits = 0
+        self.rewrites = 0
+        self.elapsed = 0.0
+
+    def __repr__(self):
+        return '<PassStats visits={0} rewrites={1} elapsed={2:.6f}>'.format(
+            self.visits, self.rewrites, self.elapsed)
+
+
+class LineNode(object):
+    """Line in the list being optimized
+
+    Attributes
+    ----------
+    expr : Expression
+    prev : LineNode or None
+    next : LineNode or None
+    """
+    __slots__ = ('expr', 'prev', 'next', 'queued', 'removed')
+
+    def __init__(self, expr):
+        self.expr = expr
+        self.prev = None
+        self.next = None
+        self.queued = False
+        self.removed = False
+
+
+class Pass(object):
+    """Base optimization pass
+
+    Derived classes implement `visit`, which looks at one line and its
+    neighbours and rewrites them through the PassManager.
+    """
+    @property
+    def name(self):
+        return self.__class__.__name__
+
+    def visit(self, manager, node):
+        """Try to rewrite around `node`
+
+        Returns
+        -------
+        rewritten : bool
+            Whether anything was changed
+        """
+        return False
+
+
+class PassManager(object):
+    """Run passes over a list of lines until none of them changes anything
+
+    Lines are held in a linked list. Every line starts on the worklist.
+    When a pass rewrites something, only the new lines and their neighbours
+    are queued again, so lines far from a change are not revisited.
+    Lines are taken from the end first, so inner constructs are rewritten
+    before the ones around them.
+
+    Nested blocks are treated as single lines.
+
+    Attributes
+    ----------
+    passes : list of Pass
+        Passes in the order they are tried on each line
+    stats : OrderedDict
+        Map of pass name to its PassStats, accumulated over every run
+
+    Example
+    -------
+    >>> manager = PassManager([NoopRemovalPass, ConditionalBlockPass])
+    >>> lines = manager.run(lines)
+    >>> manager.stats['NoopRemovalPass'].rewrites
+    3
+    """
+    def __init__(self, passes):
+        self.passes = [opt() if isinstance(opt, type) else opt
+                       for opt in passes]
+        self.stats = collections.OrderedDict(
+            (opt.name, PassStats()) for opt in self.passes)
+        self.head = None
+        self.worklist = []
+        self.jump_counts = collections.defaultdict(int)
+
+    def run(self, lines):
+        """Optimize `lines`
+
+        Returns
+        -------
+        lines : list
+            Optimized lines
+        """
+        self.head = None
+        self.worklist = []
+        self.jump_counts.clear()
+        prev = None
+        for expr in lines:
+            node = self._link(expr, prev)
+            self.queue(node)
+            prev = node
+        timer = timeit.default_timer
+        while self.worklist:
+            node = self.worklist.pop()
+            node.queued = False
+            if node.removed:
+                continue
+            for opt in self.passes:
+                stats = self.stats[opt.name]
+                stats.visits += 1
+                start = timer()
+                rewritten = opt.visit(self, node)
+                stats.elapsed += timer()-start
+                if rewritten:
+                    stats.rewrites += 1
+                    break
+        lines = []
+        node = self.head
+        while node is not None:
+            lines.append(node.expr)
+            node = node.next
+        return lines
+
+    def _link(self, expr, prev):
+        node = LineNode(expr)
+        node.prev = prev
+        if prev is None:
+            node.next = self.head
+            self.head = node
+        else:
+            node.next = prev.next
+            prev.next = node
+        if node.next is not None:
+            node.next.prev = node
+        if type(expr) is JumpExpression:
+            self.jump_counts[expr.target] += 1
+        return node
+
+    def _unlink(self, node):
+        if node.prev is None:
+            self.head = node.next
+        else:
+            node.prev.next = node.next
+        if node.next is not None:
+            node.next.prev = node.prev
+        node.removed = True
+        if type(node.expr) is JumpExpression:
+            self.jump_counts[node.expr.target] -= 1
+
+    def queue(self, node):
+        if node is not None and not node.queued and not node.removed:
+            node.queued = True
+            self.worklist.append(node)
+
+    def references(self, target):
+        """Get the number of jumps to `target` still in the list
+        """
+        return self.jump_counts.get(target, 0)
+
+    def splice(self, first, last, exprs):
+        """Replace the lines from `first` to `last` inclusive with `exprs`
+
+        The new lines and the lines on either side are queued.
+
+        Returns
+        -------
+        nodes : list of LineNode
+            Nodes of the new lines
+        """
+        prev = first.prev
+        after = last.next
+        node = first
+        while True:
+            following = node.next
+            self._unlink(node)
+            if node is last:
+                break
+            node = following
+        nodes = []
+        for expr in exprs:
+            prev = self._link(expr, prev)
+            nodes.append(prev)
+        for node in reversed(nodes):
+            self.queue(node)
+        self.queue(prev)
+        self.queue(after)
+        if nodes:
+            self.queue(nodes[0].prev)
+        return nodes
+
+    def remove(self, node):
+        """Remove the line of `node`
+        """
+        self.splice(node, node, ())
+
+
+class NoopRemovalPass(Pass):
+    """Drop lines that print nothing
+    """
+    def visit(self, manager, node):
+        if not isinstance(node.expr, NoopExpression):
+            return False
+        manager.remove(node)
+        return True
+
+
+class AssignmentInliningPass(Pass):
+    """Drop assignments to temporaries that are printed by value
+
+    An unnamed variable that is not persistent and has a `refcount` of 1
+    is printed as its value at its only use (see `Variable.__str__`), so
+    its assignment line is redundant. Unused variables keep their
+    assignment, since its value may have side effects. Named variables,
+    like those of `engine.vars`, are storage read outside the script, so
+    their assignments are always kept.
+    """
+    def visit(self, manager, node):
+        expr = node.expr
+        if type(expr) is not AssignmentExpression:
+            return False
+        dest = expr.dest
+        if (not isinstance(dest, Variable) or dest.name is not None or
+                dest.persist or dest.refcount != 1):
+            return False
+        manager.remove(node)
+        return True
+
+
+class ConditionalBlockPass(Pass):
+    """Recover if and if/else blocks from conditional jumps
+
+    Patterns
+    --------
+    jump(L1, unless=cond), body..., label(L1)
+        becomes an if block
+    jump(L1, unless=cond), body..., jump(L2), label(L1), other...,
+    label(L2)
+        becomes an if block followed by an else block
+
+    Bodies may not contain other jumps or labels. Since lines are visited
+    from the end, nested constructs have already been recovered by the
+    time the one around them is visited. Labels are kept while other
+    jumps still reach them.
+    """
+    @staticmethod
+    def _body(node, target):
+        """Get the lines after `node` up to the label of `target`
+
+        Returns
+        -------
+        body : list of LineNode or None
+            Lines strictly between `node` and the label, or None if the
+            label is not reached
+        label : LineNode or None
+        """
+        body = []
+        node = node.next
+        while node is not None:
+            expr = node.expr
+            if type(expr) is LabelExpression:
+                if expr.target == target:
+                    return body, node
+                return None, None
+            body.append(node)
+            node = node.next
+        return None, None
+
+    @staticmethod
+    def _block(header, body):
+        block = ExpressionBlock()
+        block.header_lines = [header]
+        block.lines = [node.expr for node in body]
+        return block
+
+    def visit(self, manager, node):
+        expr = node.expr
+        if type(expr) is not JumpExpression or expr.unless is None:
+            return False
+        body, label = self._body(node, expr.target)
+        if body is None:
+            return False
+        jumps = [line for line in body
+                 if type(line.expr) is JumpExpression]
+        if not jumps:
+            exprs = [self._block(ConditionalExpression(expr.unless), body)]
+            last = label
+            if manager.references(expr.target) > 1:
+                exprs.append(label.expr)
+            manager.splice(node, last, exprs)
+            return True
+        # if/else: the only jump must end the body and skip the else
+        skip = jumps[0]
+        if (len(jumps) > 1 or skip is not body[-1] or
+                skip.expr.unless is not None or
+                manager.references(expr.target) > 1):
+            return False
+        else_body, end_label = self._body(label, skip.expr.target)
+        if else_body is None or any(type(line.expr) is JumpExpression
+                                    for line in else_body):
+            return False
+        exprs = [
+            self._block(ConditionalExpression(expr.unless), body[:-1]),
+            self._block(ConditionalExpression(
+                None, ConditionalExpression.TYPE_ELSE), else_body)]
+        if manager.references(skip.expr.target) > 1:
+            exprs.append(end_label.expr)
+        manager.splice(node, end_label, exprs)
+        return True
@@ -0,0 +1,203 @@
+
+import mmap
+import struct
+
+from compileengine.engine import EngineBlock
+
+MAGIC = b'PCEB'
+VERSION = 1
+
+# magic, version, pointer size, flags, block count, relocation count
+HEADER = struct.Struct('<4sHBBII')
+# data offset, data length, first relocation, relocation count
+BLOCK_ENTRY = struct.Struct('<IIII')
+# slot offset, target block index, kind
+RELOCATION_ENTRY = struct.Struct('<IIB')
+
+
+class FormatError(ValueError):
+    pass
+
+
+def dumps(engine, root_block):
+    """Serialize the blocks reachable from `root_block`
+
+    Layout
+    ------
+    header, block table, relocation table, then the raw block data. Blocks
+    are stored in `Engine.layout` order, so the entry block is block 0.
+    Relocations refer to their target by block index.
+
+    Returns
+    -------
+    data : bytes
+    """
+    blocks = engine.layout(root_block)
+    index = dict((id(block), idx) for idx, block in enumerate(blocks))
+    block_table = []
+    relocations = []
+    data_offset = 0
+    for block in blocks:
+        block_table.append(BLOCK_ENTRY.pack(
+            data_offset, len(block.buff), len(relocations), len(block.jumps)))
+        data_offset += len(block.buff)
+        for ofs, target in sorted(block.jumps.items()):
+            relocations.append(RELOCATION_ENTRY.pack(
+                ofs, index[id(target)],
+                block.kinds.get(ofs, block.KIND_JUMP)))
+    header = HEADER.pack(MAGIC, VERSION, engine.pointer_size, 0,
+                         len(blocks), len(relocations))
+    return b''.join([header]+block_table+relocations+
+                    [bytes(block.buff) for block in blocks])
+
+
+def dump(engine, root_block, handle):
+    """Write the blocks reachable from `root_block` to `handle`
+    """
+    handle.write(dumps(engine, root_block))
+
+
+class BlockGraph(object):
+    """Read-only view over a serialized block graph
+
+    Nothing is decoded until it is asked for, so this can sit on top of an
+    mmap of a large file.
+
+    Attributes
+    ----------
+    buffer : memoryview
+        Serialized data
+    pointer_size : int
+        Pointer size of the engine that produced the data
+    """
+    def __init__(self, buff):
+        self.buffer = memoryview(buff)
+        try:
+            (magic, version, self.pointer_size, flags, self.block_count,
+             self.relocation_count) = HEADER.unpack_from(self.buffer, 0)
+        except struct.error:
+            raise FormatError('Truncated block graph header')
+        if magic != MAGIC:
+            raise FormatError('Not a block graph')
+        if version != VERSION:
+            raise FormatError('Unsupported block graph version {0}'.format(
+                version))
+        self.relocation_start = HEADER.size+self.block_count*BLOCK_ENTRY.size
+        self.data_start = (self.relocation_start +
+                           self.relocation_count*RELOCATION_ENTRY.size)
+
+    def __len__(self):
+        return self.block_count
+
+    def _entry(self, idx):
+        if not 0 <= idx < self.block_count:
+            raise IndexError(idx)
+        return BLOCK_ENTRY.unpack_from(self.buffer,
+                                       HEADER.size+idx*BLOCK_ENTRY.size)
+
+    def data(self, idx):
+        """Get a view of the bytes of block `idx`
+        """
+        data_offset, length, first, count = self._entry(idx)
+        start = self.data_start+data_offset
+        return self.buffer[start:start+length]
+
+    def relocations(self, idx):
+        """Get the jumps of block `idx`
+
+        Returns
+        -------
+        relocations : list of (int, int, int)
+            (slot offset, target block index, kind)
+        """
+        data_offset, length, first, count = self._entry(idx)
+        return [RELOCATION_ENTRY.unpack_from(
+                    self.buffer,
+                    self.relocation_start+pos*RELOCATION_ENTRY.size)
+                for pos in range(first, first+count)]
+
+    def to_blocks(self, engine):
+        """Rebuild the EngineBlocks on `engine`
+
+        The blocks are added to `engine.blocks`, after any blocks it
+        already has.
+
+        Returns
+        -------
+        block : EngineBlock
+            Entry block
+
+        Raises
+        ------
+        FormatError
+            If the graph was written with a different pointer size than
+            `engine` uses
+        """
+        if self.pointer_size != engine.pointer_size:
+            raise FormatError(
+                'Block graph has {0} byte pointers, engine uses {1}'.format(
+                    self.pointer_size, engine.pointer_size))
+        blocks = [EngineBlock(engine) for idx in range(self.block_count)]
+        for idx, block in enumerate(blocks):
+            block.buff = bytearray(self.data(idx))
+            block.complete = True
+            for ofs, target, kind in self.relocations(idx):
+                block.add_jump(ofs, blocks[target], kind)
+        engine.blocks.extend(blocks)
+        engine.script_block = blocks[0]
+        return blocks[0]
+
+    def close(self):
+        self.buffer.release()
+
+
+def loads(engine, data):
+    """Load a serialized block graph into `engine`
+
+    Returns
+    -------
+    block : EngineBlock
+        Entry block
+    """
+    graph = BlockGraph(data)
+    try:
+        return graph.to_blocks(engine)
+    finally:
+        graph.close()
+
+
+def open_graph(path):
+    """Map a serialized block graph file without reading it
+
+    Returns
+    -------
+    graph : BlockGraph
+    """
+    with open(path, 'rb') as handle:
+        data = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+    return BlockGraph(data)
+
+
+def diff(old, new):
+    """Find the blocks that differ between two builds
+
+    Blocks are matched by index, which follows layout order.
+
+    Parameters
+    ----------
+    old : BlockGraph
+    new : BlockGraph
+
+    Returns
+    -------
+    changed : list of int
+        Indices of blocks that changed, were added or were removed
+    """
+    changed = []
+    for idx in range(max(len(old), len(new))):
+        if idx >= len(old) or idx >= len(new):
+            changed.append(idx)
+        elif (old.data(idx) != new.data(idx) or
+              old.relocations(idx) != new.relocations(idx)):
+            changed.append(idx)
+    return changed
@@ -1,28 +1,125 @@
 
+import numbers
 import string
 import operator
+import weakref
 
 OP_PRECEDENCE = [
     (operator.mul, ),
     (operator.add, operator.sub)
 ]
 
+# Operator to (operator, constant) normalization for reassociation
+REASSOCIATIVE = {
+    operator.add: lambda value: (operator.add, value),
+    operator.sub: lambda value: (operator.add, -value),
+    operator.mul: lambda value: (operator.mul, value),
+    operator.lshift: lambda value: (operator.lshift, value),
+    operator.rshift: lambda value: (operator.rshift, value),
+}
+
+# How two constants of the same normalized operator are merged
+REASSOCIATE_COMBINE = {
+    operator.add: operator.add,
+    operator.mul: operator.mul,
+    operator.lshift: operator.add,
+    operator.rshift: operator.add,
+}
+
+IDENTITIES = {
+    operator.add: 0,
+    operator.sub: 0,
+    operator.mul: 1,
+    operator.lshift: 0,
+    operator.rshift: 0,
+}
+
 
 class Variable(object):
+    # __dict__ is only allocated once something outside the slots is set,
+    # like a per-variable namespace overriding the class default
+    __slots__ = ('base', 'value', 'name', 'engine', 'refcount', 'persist',
+                 'const', '_refby', '_fallback_name', '__weakref__',
+                 '__dict__')
+    namespace = 'engine.vars.'
+
     def __init__(self, base=None, value=None):
         self.base = base
         self.value = value
         self.name = None
-        self.fallback_name = 'default_{0:x}'.format(id(self))
         self.refcount = 0
         self.persist = False
         self.const = True
-        self.refby = []
-        self.namespace = 'engine.vars.'
+        self._refby = None
+        self._fallback_name = None
+
+    @property
+    def fallback_name(self):
+        if self._fallback_name is None:
+            return 'default_{0:x}'.format(id(self))
+        return self._fallback_name
+
+    @fallback_name.setter
+    def fallback_name(self, value):
+        self._fallback_name = value
+
+    @property
+    def refby(self):
+        """Live variables derived from this one
+
+        Only weak references are kept, so derived variables are freed as
+        soon as nothing else uses them.
+        """
+        if self._refby is None:
+            return []
+        return [var for var in (ref() for ref in self._refby)
+                if var is not None]
+
+    def add_ref(self, var):
+        """Record that `var` was derived from this variable
+        """
+        self.refcount += 1
+        refs = self._refby
+        if refs is None:
+            refs = self._refby = []
+        elif len(refs) >= 8 and not len(refs) & (len(refs)-1):
+            # Drop dead references whenever the list doubles in size
+            refs[:] = [ref for ref in refs if ref() is not None]
+        refs.append(weakref.ref(var))
+
+    def release_refs(self):
+        """Forget every reference to this variable
+
+        The engine calls this on its variables before replaying each path,
+        so `refcount` only counts uses within the current path.
+        """
+        self.refcount = 0
+        self._refby = None
 
     def has_value(self):
         return self.value is not None
 
+    def is_constant(self):
+        """Whether the value of this variable is known at compile time
+        """
+        try:
+            self.get_constant()
+        except ValueError:
+            return False
+        return True
+
+    def get_constant(self):
+        """Evaluate the value of this variable at compile time
+
+        Raises
+        ------
+        ValueError
+            If any part of the value is not a known constant
+        """
+        if not self.const:
+            raise ValueError('{0!r} is not constant'.format(self))
+        return constant_value(self.value)
+
     def __str__(self):
         if not self.persist and self.refcount < 2:
             # TODO: complex stringification
@@ -40,67 +137,145 @@ class Variable(object):
         return '<{cls} ({name}) at {id:#x}>'.format(
             cls=self.__class__.__name__, name=self.get_name(), id=id(self))
 
-    """def __add__(self, other):
-        self.refcount += 1
-        if isinstance(other, Variable):
-            other.refcount += 1
-        else:
-            try:
-                oper, operand1, operand2 = self.value
-                if oper == operator.add:
-                    try:
-                        new_operand2 = operand2+other
-                        if not isinstance(new_operand2, Variable):
-                            return Variable(value=[operator.add, operand1, new_operand2])
-                    except:
-                        pass
-                    try:
-                        new_operand1 = operand1+other
-                        if not isinstance(new_operand1, Variable):
-                            return Variable(value=[operator.add, new_operand1, operand2])
-                    except:
-                        pass
-            except:
-                return Variable(value=[operator.add, self, other])"""
-
     def operate(self, oper, other):
-        self.refcount += 1
+        """Build a new variable for `oper` applied to this and `other`
+
+        Constant operands are evaluated here, and a constant applied to the
+        result of the same kind of operation is merged into it, so
+        (x + 1) + 2 becomes x + 3 instead of a nested expression.
+        """
+        folded = self.fold(oper, other)
+        if folded is not None:
+            return folded
         new_var = Variable()
-        self.refby.append(new_var)
+        new_var.const = self.const
+        self.add_ref(new_var)
         if isinstance(other, Variable):
-            other.refcount += 1
-            other.refby.append(new_var)
+            other.add_ref(new_var)
+            new_var.const = new_var.const and other.const
         new_var.value = (oper, self.value, other)
         return new_var
 
-    def __add__(self, other):
-        if other is 0:
+    def fold(self, oper, other):
+        """Simplify `oper` applied to this and `other` at compile time
+
+        Returns
+        -------
+        variable : Variable or None
+            The simplified variable, or None if nothing could be simplified
+        """
+        try:
+            rhs = constant_value(other)
+        except ValueError:
+            return None
+        try:
+            return Variable(value=oper(self.get_constant(), rhs))
+        except ValueError:
+            pass
+        if is_identity(oper, rhs):
             return self
+        try:
+            base_oper, rhs = REASSOCIATIVE[oper](rhs)
+            inner_oper, lhs, inner_rhs = self.value
+            inner_oper, inner_rhs = REASSOCIATIVE[inner_oper](
+                constant_value(inner_rhs))
+        except (KeyError, TypeError, ValueError):
+            return None
+        if inner_oper is not base_oper:
+            return None
+        rhs = REASSOCIATE_COMBINE[base_oper](inner_rhs, rhs)
+        if is_identity(base_oper, rhs):
+            # The constants cancel out, as in (x + 1) - 1
+            if isinstance(lhs, Variable):
+                return lhs
+            new_var = Variable(value=lhs)
+            new_var.const = self.const
+            return new_var
+        if base_oper is operator.add and rhs < 0:
+            value = (operator.sub, lhs, -rhs)
+        else:
+            value = (base_oper, lhs, rhs)
+        new_var = Variable(value=value)
+        new_var.const = self.const
+        return new_var
+
+    def __add__(self, other):
         return self.operate(operator.add, other)
 
     def __sub__(self, other):
-        if other is 0:
-            return self
         return self.operate(operator.sub, other)
 
     def __mul__(self, other):
-        if other is 1:
-            return self
         return self.operate(operator.mul, other)
 
     def __neg__(self):
         return self.operate(operator.mul, -1)
 
     def __lshift__(self, other):
-        if other is 0:
-            return self
         return self.operate(operator.lshift, other)
 
     def __rshift__(self, other):
-        if other is 0:
-            return self
         return self.operate(operator.rshift, other)
 
+    def compare(self, oper, other):
+        """Build a condition variable for the comparison `oper`
+
+        Like `operate`, but constants are never folded away, and both
+        operands are kept as `operands` so the condition can be told
+        apart by identity and rebuilt later.
+        """
+        new_var = Variable(value=(oper, self.value, other))
+        new_var.const = self.const
+        new_var.operands = (self, other)
+        self.add_ref(new_var)
+        if isinstance(other, Variable):
+            other.add_ref(new_var)
+            new_var.const = new_var.const and other.const
+        return new_var
+
+    def __lt__(self, other):
+        return self.compare(operator.lt, other)
+
+    def __le__(self, other):
+        return self.compare(operator.le, other)
+
+    def __gt__(self, other):
+        return self.compare(operator.gt, other)
+
+    def __ge__(self, other):
+        return self.compare(operator.ge, other)
+
+    def __eq__(self, other):
+        if not isinstance(other, (Variable, numbers.Number)):
+            return NotImplemented
+        return self.compare(operator.eq, other)
+
+    def __ne__(self, other):
+        if not isinstance(other, (Variable, numbers.Number)):
+            return NotImplemented
+        return self.compare(operator.ne, other)
+
+    def __bool__(self):
+        """Whether ``==`` and ``!=`` hold for the operands' identities
+
+        This keeps ``in``, `list.index` and `list.remove` matching the
+        same Variable object rather than any Variable. Other variables
+        are always true.
+        """
+        try:
+            lhs, rhs = self.operands
+        except AttributeError:
+            return True
+        if self.value[0] is operator.eq:
+            return lhs is rhs
+        if self.value[0] is operator.ne:
+            return lhs is not rhs
+        return True
+
+    __nonzero__ = __bool__
+
+    __hash__ = object.__hash__
+
     @staticmethod
     def name_generator(prefix='local_'):
         idx = 0
@@ -110,3 +285,31 @@ class Variable(object):
                             for c in '{0:o}'.format(idx)])
             yield prefix+name
             idx += 1
+
+
+def constant_value(value):
+    """Evaluate a variable, value or (oper, lhs, rhs) tuple at compile time
+
+    Raises
+    ------
+    ValueError
+        If any part of the value is not a known constant
+    """
+    if isinstance(value, Variable):
+        return value.get_constant()
+    if isinstance(value, tuple) and len(value) == 3 and callable(value[0]):
+        oper, lhs, rhs = value
+        return oper(constant_value(lhs), constant_value(rhs))
+    if isinstance(value, numbers.Number):
+        return value
+    raise ValueError('{0!r} is not constant'.format(value))
+
+
+def is_identity(oper, value):
+    """Whether applying `oper` with the constant `value` changes nothing
+    """
+    try:
+        identity = IDENTITIES[oper]
+    except KeyError:
+        return False
+    return not isinstance(value, bool) and value == identity